@@ -16,6 +16,8 @@ class attention(nn.Module):
     --------
         forward: torch.Tensor -> torch.Tensor
             forward pass of the attention module
+        inference: torch.Tensor -> torch.Tensor
+            forward pass without autograd state
 
     """
 
@@ -27,16 +29,17 @@ class attention(nn.Module):
         self.scale = self.att_dim ** -0.5
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        e = torch.matmul(x, self.W)
-        e = torch.matmul(torch.tanh(e), self.V)
-        e = e * self.scale
-        n1 = torch.exp(e)
-        n2 = torch.sum(torch.exp(e), 1, keepdim=True)
-        alpha = torch.div(n1, n2)
-        x = torch.sum(torch.mul(alpha, x), 1)
+        # x: (B, C, T), scores over T from a single softmax, computed in float32 so
+        # large scores cannot overflow under autocast
+        e = torch.matmul(torch.tanh(torch.matmul(x.transpose(1, 2), self.W)), self.V)
+        alpha = torch.softmax(e.float() * self.scale, dim=1)  # B, T, 1
+        x = torch.bmm(x, alpha.to(x.dtype)).squeeze(-1)  # B, C
         return x
 
+    @torch.inference_mode()
+    def inference(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x)
+
 
 class encoder(nn.Module):
     """
@@ -59,7 +62,7 @@ class encoder(nn.Module):
         self.model = BaseNet()
         self.attention = attention()
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.model(x)
         x = self.attention(x)
         return x
@@ -160,8 +163,8 @@ class sleep_model(nn.Module):
         self.top_curr_pred = predictor_head(config)
         self.top_surr_pred = predictor_head(config)
 
-        self.top_tfmr = Transformer(256, 4, 4, 256, dropout=0.1)
-        self.bot_tfmr = Transformer(256, 4, 4, 256, dropout=0.1)
+        self.top_tfmr = Transformer(256, 4, 4, 256, dropout=0.1, backend=config.attn_backend)
+        self.bot_tfmr = Transformer(256, 4, 4, 256, dropout=0.1, backend=config.attn_backend)
         
         for param_q, param_k in zip(self.top_tfmr.parameters(),
                                     self.bot_tfmr.parameters()):
@@ -169,24 +172,44 @@ class sleep_model(nn.Module):
             param_k.requires_grad = False  # not update by gradient
 
 
+    def encode_epochs(self, encoder: nn.Module, data: torch.Tensor) -> torch.Tensor:
+        """Encodes every epoch of (B, epoch_len, 3000) data with a single encoder call.
+
+        Returns the (B, epoch_len, 256) features. In train mode BatchNorm normalizes over
+        all B * epoch_len windows, use check_encode_epochs to compare against the
+        per-epoch loop.
+        """
+
+        batch_size, epoch_len, _ = data.shape
+        feats = encoder(data.reshape(batch_size * epoch_len, 1, -1))
+        return feats.view(batch_size, epoch_len, -1)
+
+    @torch.no_grad()
+    def check_encode_epochs(self, data: torch.Tensor, atol: float = 1e-5) -> bool:
+        """Checks in eval mode that encode_epochs matches encoding one epoch at a time."""
+
+        was_training = self.training
+        self.eval()
+        data = data.float()
+        encoder = self.top_encoder
+        folded = self.encode_epochs(encoder, data)
+        looped = torch.stack(
+            [encoder(data[:, i : i + 1, :]) for i in range(data.shape[1])], dim=1
+        )
+        self.train(was_training)
+        return torch.allclose(folded, looped, atol=atol)
+
     def forward(self, top_data: torch.Tensor, bot_data: torch.Tensor):
 
         top_data = top_data.float()
         bot_data = bot_data.float()
 
-        top_surr = []
-        bot_surr = []
-
-        for i in range(self.config.epoch_len):
-            top_surr.append(self.top_encoder(top_data[:, i : i + 1, :]))
-            bot_surr.append(self.bot_encoder(bot_data[:, i : i + 1, :]))
+        top_surr = self.encode_epochs(self.top_encoder, top_data)
+        bot_surr = self.encode_epochs(self.bot_encoder, bot_data)
 
         ep = torch.randint(self.config.epoch_len, (1,)).item()
-        top_curr = top_surr[ep]
-        bot_curr = bot_surr[ep]
-
-        top_surr = torch.stack(top_surr, dim=1)
-        bot_surr = torch.stack(bot_surr, dim=1)
+        top_curr = top_surr[:, ep]
+        bot_curr = bot_surr[:, ep]
 
         top_surr = self.top_tfmr(top_surr)
         bot_surr = self.bot_tfmr(bot_surr)
@@ -13,6 +13,9 @@ This file can also be imported as a module and contains the following functions:
     * multi_masking - Masks multiple segments of the EEG signal randomly.
     * flip - Applies a horizontal flip to the EEG signal.
     * augment - Builds the augmentations pipeline.
+    * jitter_batch, scaling_batch, masking_batch, flip_batch - Vectorized versions for a batch of epochs.
+    * augment_batch - Builds the augmentations pipeline for a batch of epochs in one vectorized pass.
+    * augment_torch - Builds the augmentations pipeline for a batch of epochs on the training device.
 
 """
 __author__ = "Likith Reddy, Vamsi Kumar"
@@ -20,10 +23,12 @@ __version__ = "1.0.0"
 __email__ = "likith012@gmail.com, vamsi81523@gmail.com"
 
 #%%
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from scipy.interpolate import interp1d
 
 
@@ -229,3 +234,263 @@ def augment(
     strong_augment = scaling(flip(x), config, degree=degree)
     return weak_augment, strong_augment
 
+
+def _sample_rngs(batch_size: int, rng=None) -> List[np.random.Generator]:
+    """Returns one independent random generator per sample of a batch.
+
+    Parameters
+    ----------
+    batch_size: int
+        Number of samples in the batch.
+    rng: int or list of np.random.Generator, optional
+        Seed of the batch or one generator per sample. Drawn from the global numpy
+        state when not given, so DataLoader worker seeding still applies.
+
+    Returns
+    -------
+    List[np.random.Generator]
+        Per-sample random generators.
+    """
+
+    if isinstance(rng, (list, tuple)):
+        assert len(rng) == batch_size, "one generator per sample is required"
+        return list(rng)
+    if rng is None:
+        rng = np.random.randint(2**32, dtype=np.int64)
+    seeds = np.random.SeedSequence(int(rng)).spawn(batch_size)
+    return [np.random.default_rng(s) for s in seeds]
+
+
+@lru_cache(maxsize=None)
+def _upsample_weights(n_in: int, n_out: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Knot indices and weights of a linear upsampling from n_in to n_out points."""
+
+    pos = np.linspace(0, n_in - 1, num=n_out, endpoint=True)
+    left = np.minimum(pos.astype(np.int64), n_in - 2)
+    return left, (pos - left).astype(np.float32)
+
+
+def jitter_batch(
+    x: np.ndarray, config, rngs: List[np.random.Generator], degree: float = 1.0
+) -> np.ndarray:
+    """Batched version of jitter, adds low and high frequency noise to every channel.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        EEG signals of shape (batch, epochs, channels, samples).
+    config
+        Configuration object.
+    rngs: List[np.random.Generator]
+        One random generator per sample.
+    degree: float, optional
+        Degree of uniform noise to be added.
+
+    Returns
+    -------
+    np.ndarray
+        Augmented EEG signals.
+    """
+
+    _, n_epochs, n_channels, len_x = x.shape
+    degree = config.degree * degree
+    # add a small number for flat signal
+    num_range = np.ptp(x, axis=-1, keepdims=True) + 1e-4
+
+    noise_high_frequency = np.stack(
+        [r.random((n_epochs, n_channels, len_x), dtype=np.float32) for r in rngs]
+    )
+    noise_low_frequency = np.stack(
+        [r.random((n_epochs, n_channels, len_x // 100), dtype=np.float32) for r in rngs]
+    )
+    left, weight = _upsample_weights(len_x // 100, len_x)
+    noise_low_frequency = (
+        noise_low_frequency[..., left] * (1 - weight)
+        + noise_low_frequency[..., left + 1] * weight
+    )
+
+    noise1 = 2.0 * noise_high_frequency - 1
+    noise2 = 2.0 * noise_low_frequency - 1
+    return x + degree * num_range * (noise1 + noise2)
+
+
+def scaling_batch(
+    x: np.ndarray, config, rngs: List[np.random.Generator], degree: float = 2.0
+) -> np.ndarray:
+    """Batched version of scaling, applies Gaussian noise to every epoch.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        EEG signals of shape (batch, epochs, channels, samples).
+    config
+        Configuration object.
+    rngs: List[np.random.Generator]
+        One random generator per sample.
+    degree: float, optional
+        Degree of Gaussian noise to be added.
+
+    Returns
+    -------
+    np.ndarray
+        Augmented EEG signals.
+    """
+
+    _, n_epochs, _, len_x = x.shape
+    uniform = np.stack([r.random((n_epochs, 2), dtype=np.float32) for r in rngs])
+    normal = np.stack(
+        [r.standard_normal((n_epochs, len_x), dtype=np.float32) for r in rngs]
+    )
+    degree = config.degree * (degree + uniform[..., :1])
+    factor = 1.5 + (2.0 * uniform[..., 1:]) + degree * (2.0 * normal - 1)
+    return x * factor[:, :, None, :]
+
+
+def masking_batch(
+    x: np.ndarray, config, rngs: List[np.random.Generator]
+) -> np.ndarray:
+    """Batched version of masking, masks a single segment of every epoch.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        EEG signals of shape (batch, epochs, channels, samples).
+    config
+        Configuration object.
+    rngs: List[np.random.Generator]
+        One random generator per sample.
+
+    Returns
+    -------
+    np.ndarray
+        Augmented EEG signals.
+    """
+
+    _, n_epochs, _, len_x = x.shape
+    uniform = np.stack([r.random((n_epochs, 2)) for r in rngs])
+    segments = config.mask_min_points + (
+        uniform[..., 0] * (config.mask_max_points - config.mask_min_points)
+    ).astype(np.int64)
+    points = (uniform[..., 1] * (len_x - segments)).astype(np.int64)
+    time = np.arange(len_x)
+    mask = (time >= points[..., None]) & (time < (points + segments)[..., None])
+    return np.where(mask[:, :, None, :], np.zeros((), dtype=x.dtype), x)
+
+
+def flip_batch(x: np.ndarray, rngs: List[np.random.Generator]) -> np.ndarray:
+    """Batched version of flip, flips every epoch horizontally with probability 0.5.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        EEG signals of shape (batch, epochs, channels, samples).
+    rngs: List[np.random.Generator]
+        One random generator per sample.
+
+    Returns
+    -------
+    np.ndarray
+        Flipped EEG signals.
+    """
+
+    flipped = np.stack([r.random(x.shape[1]) for r in rngs]) > 0.5
+    return np.where(flipped[:, :, None, None], x[..., ::-1], x)
+
+
+def augment_batch(
+    x: np.ndarray, config, degree: float = 3.0, rng=None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Applies strong and weak augmentations on a batch of EEG signals in one pass.
+
+    Every epoch draws its own augmentation parameters, as augment does, from the
+    random stream of its sample.
+
+    Parameters
+    ----------
+    x: np.ndarray
+        EEG signals of shape (batch, epochs, channels, samples).
+    config
+        Configuration object.
+    degree: float, optional
+        Degree of noise to be added.
+    rng: int or list of np.random.Generator, optional
+        Seed of the batch or one generator per sample.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+       Weak and strong augmented views of shape (batch, epochs, channels, samples).
+
+    """
+
+    x = np.asarray(x, dtype=np.float32)
+    rngs = _sample_rngs(x.shape[0], rng)
+    weak_augment = masking_batch(jitter_batch(x, config, rngs), config, rngs)
+    strong_augment = scaling_batch(
+        flip_batch(x, rngs), config, rngs, degree=degree
+    )
+    return weak_augment, strong_augment
+
+
+@torch.no_grad()
+def augment_torch(
+    x: torch.Tensor, config, degree: float = 3.0, generator: Optional[torch.Generator] = None
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Torch implementation of augment_batch that runs on the device of the input.
+
+    Used to build the two views on the training device after the raw windows were
+    transferred, instead of augmenting in the DataLoader workers.
+
+    Parameters
+    ----------
+    x: torch.Tensor
+        EEG signals of shape (batch, epochs, samples) or (batch, epochs, channels, samples).
+    config
+        Configuration object.
+    degree: float, optional
+        Degree of noise to be added.
+    generator: torch.Generator, optional
+        Random generator on the device of x.
+
+    Returns
+    -------
+    Tuple[torch.Tensor, torch.Tensor]
+       Weak and strong augmented views with the shape of the input.
+
+    """
+
+    squeeze = x.dim() == 3
+    x = x.float().unsqueeze(2) if squeeze else x.float()
+    batch_size, n_epochs, n_channels, len_x = x.shape
+
+    def rand(*size):
+        return torch.rand(size, device=x.device, generator=generator)
+
+    # weak: jitter and masking
+    num_range = x.amax(dim=-1, keepdim=True) - x.amin(dim=-1, keepdim=True) + 1e-4
+    noise_high_frequency = 2.0 * rand(batch_size, n_epochs, n_channels, len_x) - 1
+    noise_low_frequency = 2.0 * rand(batch_size * n_epochs * n_channels, 1, len_x // 100) - 1
+    noise_low_frequency = F.interpolate(
+        noise_low_frequency, size=len_x, mode="linear", align_corners=True
+    ).view(batch_size, n_epochs, n_channels, len_x)
+    weak_augment = x + config.degree * num_range * (noise_high_frequency + noise_low_frequency)
+
+    segments = config.mask_min_points + (
+        rand(batch_size, n_epochs) * (config.mask_max_points - config.mask_min_points)
+    ).long()
+    points = (rand(batch_size, n_epochs) * (len_x - segments)).long()
+    time = torch.arange(len_x, device=x.device)
+    mask = (time >= points[..., None]) & (time < (points + segments)[..., None])
+    weak_augment = weak_augment.masked_fill(mask[:, :, None, :], 0)
+
+    # strong: flip and scaling
+    flipped = rand(batch_size, n_epochs) > 0.5
+    strong_augment = torch.where(flipped[:, :, None, None], x.flip(-1), x)
+    degree = config.degree * (degree + rand(batch_size, n_epochs, 1))
+    normal = torch.randn((batch_size, n_epochs, len_x), device=x.device, generator=generator)
+    factor = 1.5 + (2.0 * rand(batch_size, n_epochs, 1)) + degree * (2.0 * normal - 1)
+    strong_augment = strong_augment * factor[:, :, None, :]
+
+    if squeeze:
+        return weak_augment.squeeze(2), strong_augment.squeeze(2)
+    return weak_augment, strong_augment
@@ -0,0 +1,136 @@
+"""Linear head on the context transformer features, for context scoring in inference.py.
+
+Linear evaluation trains its head on per-epoch encoder features, so that head cannot score
+the features of top_tfmr. This script reads the encoder and top_tfmr of a full pretraining
+checkpoint (<name>_full.pt), encodes every epoch of the labelled records once, pools the
+window centred on each epoch with the frozen transformer and trains nn.Linear(256, 5) on
+those features. The head of the epoch with the best macro-F1 on held-out subjects is saved
+with the encoder and the transformer, hypnogram_engine.from_checkpoint and
+online_scorer.from_checkpoint then build context scorers from that file.
+
+This file can also be imported as a module and contains the following:
+
+    * load_context_model - Encoder and top_tfmr of a full pretraining checkpoint.
+    * context_features - Context features and labels of records.
+    * fit_context_head - Trains the linear head on context features.
+    * save_context_head - Saves the encoder, transformer and head for inference.py.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import argparse
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import f1_score
+
+from config import Config
+from inference import STAGES, hypnogram_engine
+from models.model import encoder
+from models.tfr import Transformer
+from quantize import split_subjects
+from utils.dataloader import subject_store
+
+
+def load_context_model(chkpoint_pth: str, config: Config) -> Tuple[nn.Module, nn.Module]:
+    """top_encoder and top_tfmr of the model_state_dict of <name>_full.pt"""
+    state = torch.load(chkpoint_pth, map_location="cpu")["model_state_dict"]
+
+    def sub_state(prefix):
+        return {k[len(prefix):]: v for k, v in state.items() if k.startswith(prefix)}
+
+    eeg_encoder = encoder()
+    eeg_encoder.load_state_dict(sub_state("model.top_encoder."))
+    tfmr = Transformer(256, 4, 4, 256, dropout=0.1, backend=config.attn_backend)
+    tfmr.load_state_dict(sub_state("model.top_tfmr."))
+    return eeg_encoder, tfmr
+
+
+def context_features(engine: hypnogram_engine, records: List) -> Tuple[torch.Tensor, np.ndarray]:
+    """(N, 256) context features and labels, windows never cross the border of a record"""
+    feats, labels = [], []
+    for rec in records:
+        x = np.asarray(rec["windows"][:, :1, :], dtype=np.float32)
+        feats.append(torch.cat([f.cpu() for _, f in engine.features(x)]))
+        labels.append(np.asarray(rec["y"]))
+    # clone leaves inference mode, so the features can be trained on
+    return torch.cat(feats).clone(), np.concatenate(labels)
+
+
+def fit_context_head(
+    train: Tuple[torch.Tensor, np.ndarray],
+    valid: Tuple[torch.Tensor, np.ndarray],
+    config: Config,
+    seed: int = 1234,
+) -> Tuple[Dict[str, torch.Tensor], float]:
+    """State dict of the head with the best validation macro-F1 and that F1"""
+    torch.manual_seed(seed)
+    head = nn.Linear(256, len(STAGES))
+    optimizer = torch.optim.Adam(head.parameters(), config.lr,
+                                 betas=(config.beta1, config.beta2), weight_decay=3e-5)
+    criterion = nn.CrossEntropyLoss()
+    x, y = train[0], torch.as_tensor(train[1]).long()
+
+    best_state, best_f1 = None, -1.0
+    for _ in range(config.num_ft_epoch):
+        head.train()
+        for idx in torch.randperm(x.shape[0]).split(config.batch_size):
+            loss = criterion(head(x[idx]), y[idx])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+        head.eval()
+        with torch.no_grad():
+            preds = head(valid[0]).argmax(dim=-1).numpy()
+        f1 = f1_score(valid[1], preds, average="macro")
+        if f1 > best_f1:
+            best_f1 = f1
+            best_state = {k: v.detach().clone() for k, v in head.state_dict().items()}
+    return best_state, float(best_f1)
+
+
+def save_context_head(path: str, eeg_encoder: nn.Module, tfmr: nn.Module,
+                      lin_state: Dict[str, torch.Tensor], config: Config, f1: float):
+    torch.save({
+        "eeg_model_state_dict": eeg_encoder.state_dict(),
+        "tfmr_state_dict": tfmr.state_dict(),
+        "lin_state_dict": lin_state,
+        "epoch_len": config.epoch_len,
+        "attn_backend": config.attn_backend,
+        "f1": f1,
+    }, path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Linear head on context transformer features")
+    parser.add_argument("--chkpoint", type=str, required=True,
+                        help="<name>_full.pt of a pretraining run, with top_encoder and top_tfmr")
+    parser.add_argument("--data_dir", type=str, default="/scratch/sleepkfold_allsamples/test",
+                        help="Directory of labelled npz records")
+    parser.add_argument("--valid_fraction", type=float, default=0.2,
+                        help="Fraction of subjects held out to select the head")
+    parser.add_argument("--batch_size", type=int, default=1024,
+                        help="Epochs per encoder call and windows per transformer call")
+    parser.add_argument("--out", type=str, default="./context_head.pt")
+    args = parser.parse_args()
+
+    config = Config()
+    eeg_encoder, tfmr = load_context_model(args.chkpoint, config)
+    engine = hypnogram_engine(eeg_encoder, nn.Identity(), batch_size=args.batch_size,
+                              tfmr=tfmr, epoch_len=config.epoch_len)
+
+    files = sorted(os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir))
+    valid_records, train_records = split_subjects(subject_store(files).subjects,
+                                                  args.valid_fraction)
+    lin_state, f1 = fit_context_head(context_features(engine, train_records),
+                                     context_features(engine, valid_records), config)
+    print(f"Held-out F1: {f1:.4f}")
+
+    save_context_head(args.out, eeg_encoder, tfmr, lin_state, config, f1)
+    print(f"Saved {args.out}")
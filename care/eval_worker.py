@@ -0,0 +1,174 @@
+"""Asynchronous linear evaluation of the encoder snapshots queued during pretraining.
+
+With config.async_eval set, train.py drops a snapshot of the encoder into the evaluation
+queue at every evaluation epoch and keeps training. This script consumes the snapshots in
+epoch order, runs the k-fold linear evaluation, logs the metrics under the epoch the
+snapshot was taken at and keeps <name>_best.pt up to date. It exits once the queue is
+empty and the trainer run with the same --run_id has finished.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import wandb
+import numpy as np
+import torch
+import argparse
+import glob
+import os
+import time
+from helper_train import sleep_pretrain
+from config import Config
+from utils.dataloader import subject_store
+from utils.utils import *
+
+SEED = 1234
+torch.manual_seed(SEED)
+torch.backends.cudnn.deterministic = True
+torch.backends.cudnn.benchmark = False
+np.random.seed(SEED)
+
+
+class eval_worker(object):
+    """
+    Class for the asynchronous evaluation of queued encoder snapshots
+
+    Attributes:
+    -----------
+        config: Config object
+            Configuration object containing hyperparameters
+        name: str
+            Name of the pretraining run
+        test_subjects: list
+            Records of the linear evaluation subjects
+        wandb_logger: wandb run
+            Logger for the evaluation metrics
+
+    Methods:
+    --------
+        pending: -> list
+            queued snapshots in epoch order
+        evaluate: str -> float,float,float,float
+            linear evaluation of a single snapshot
+        run: -> None
+            consumes the queue until the trainer is done
+
+    """
+
+    # k-fold evaluation shared with the trainer, reading self.eval_chkpoint_pth
+    do_kfold = sleep_pretrain.do_kfold
+    ft_fun = sleep_pretrain.ft_fun
+
+    def __init__(self, config, name, test_subjects, wandb_logger):
+        self.config = config
+        self.name = name
+        self.test_subjects = test_subjects
+        self.loggr = wandb_logger
+        self.eval_queue_path = config.eval_queue_path or os.path.join(
+            config.exp_path, "eval_queue")
+        self.eval_chkpoint_pth = None
+
+        # Resume the best model selection of a restarted worker of the same run only, a
+        # best checkpoint of an earlier run is replaced like the trainer does
+        self.best_pth = os.path.join(config.exp_path, name + "_best.pt")
+        self.max_f1 = 0
+        if os.path.exists(self.best_pth):
+            best = torch.load(self.best_pth, map_location="cpu")
+            if best.get("run_id") == config.run_id:
+                self.max_f1 = best["f1"]
+
+    def pending(self):
+        return sorted(
+            glob.glob(os.path.join(self.eval_queue_path, self.name + "_epoch*.pt")))
+
+    def evaluate(self, snapshot_pth):
+        snapshot = torch.load(snapshot_pth, map_location="cpu")
+        epoch = snapshot["epoch"]
+
+        self.eval_chkpoint_pth = snapshot_pth
+        f1, kappa, bal_acc, acc = self.do_kfold()
+        self.loggr.log({
+            'F1': f1,
+            'Kappa': kappa,
+            'Bal Acc': bal_acc,
+            'Acc': acc,
+            'Epoch': epoch
+        })
+        print(f'Epoch: {epoch} F1: {f1} Kappa: {kappa} B.Acc: {bal_acc} Acc: {acc}')
+
+        if self.max_f1 < f1:
+            chkpoint = {
+                'eeg_model_state_dict': snapshot['eeg_model_state_dict'],
+                'best_pretrain_epoch': epoch,
+                'f1': f1
+            }
+            chkpoint['run_id'] = self.config.run_id
+            if self.best_fold_state is not None:
+                chkpoint.update(self.best_fold_state)
+            torch.save(chkpoint, self.best_pth + ".tmp")
+            os.replace(self.best_pth + ".tmp", self.best_pth)
+            self.loggr.save(self.best_pth)
+            self.max_f1 = f1
+
+        os.remove(snapshot_pth)
+        return f1, kappa, bal_acc, acc
+
+    def run(self, poll_interval=30):
+        done_pth = os.path.join(self.eval_queue_path, f"DONE_{self.config.run_id}")
+        while True:
+            pending = self.pending()
+            if pending:
+                self.evaluate(pending[0])
+            elif os.path.exists(done_pth):
+                break
+            else:
+                time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name",
+                        type=str,
+                        default="care",
+                        help="Name of the pretraining run to evaluate")
+    parser.add_argument("--save_path",
+                        type=str,
+                        default="./saved_weights",
+                        help="Path the pretraining run saves weights to")
+    parser.add_argument("--run_id",
+                        type=str,
+                        required=True,
+                        help="Run id printed by train.py, the worker exits once that run is done")
+    parser.add_argument("--poll_interval",
+                        type=float,
+                        default=30,
+                        help="Seconds between checks of an empty queue")
+
+    args = parser.parse_args()
+
+    name = args.name
+    ss_wandb = wandb.init(
+        project="carev2",
+        name=name,
+        notes="asynchronous linear evaluation",
+        job_type="eval",
+        entity="sleep-staging",
+    )
+    config = Config(ss_wandb)
+    config.run_id = args.run_id
+
+    config.exp_path = os.path.join(args.save_path, name)
+    config.le_path = "/scratch/sleepkfold_allsamples/test"
+
+    TEST_FILE = os.listdir(os.path.join(config.le_path))
+    TEST_FILE.sort(key=natural_keys)
+    TEST_FILE = [os.path.join(config.le_path, f) for f in TEST_FILE]
+
+    print(f"Number of test records: {len(TEST_FILE)}")
+
+    test_subjects = subject_store(TEST_FILE, config.subject_cache_path)
+
+    evaluator = eval_worker(config, name, test_subjects, ss_wandb)
+    evaluator.run(args.poll_interval)
+    ss_wandb.finish()
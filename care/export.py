@@ -0,0 +1,134 @@
+"""Export of a trained encoder and linear head as a self-contained TorchScript module.
+
+The exported module maps (B, 1, 3000) epochs to the logits of the 5 sleep stages
+(BaseNet -> attention -> Linear(256, 5)). It is scripted and frozen, so it loads with
+torch.jit.load alone, without this package, its Config or a checkpoint path. The weights
+come from <name>_best.pt, where linear evaluation saves the encoder and the linear head
+of its best fold. The input shape, sampling rate and class names are stored next to the
+graph as metadata.json, and the exported module is checked against ft_loss loaded from
+the same checkpoint before the command returns.
+
+This file can also be imported as a module and contains the following:
+
+    * scoring_model - Encoder followed by the linear head.
+    * load_head - Reads the linear head weights from a checkpoint.
+    * check_parity - Compares an exported module against eager mode.
+    * export - Scripts, freezes and saves a scoring_model.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import argparse
+import json
+import os
+from typing import Dict, Optional
+
+import torch
+import torch.nn as nn
+
+from config import Config
+from models.model import encoder, ft_loss
+
+METADATA = "metadata.json"
+STAGES = ["Wake", "N1", "N2", "N3", "REM"]
+
+
+class scoring_model(nn.Module):
+    """
+    Class for the deployable encoder and linear head
+
+    Attributes:
+    -----------
+        eeg_encoder: nn.Module
+            encoder mapping (B, 1, 3000) epochs to (B, 256) features
+        lin: nn.Linear
+            linear head mapping features to stage logits
+
+    Methods:
+    --------
+        forward: torch.Tensor -> torch.Tensor
+            (B, 1, 3000) epochs to (B, 5) logits
+
+    """
+
+    def __init__(self, eeg_encoder: nn.Module, lin: nn.Linear):
+        super(scoring_model, self).__init__()
+        self.eeg_encoder = eeg_encoder
+        self.lin = lin
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.lin(self.eeg_encoder(x))
+
+
+def load_head(chkpoint: Dict) -> Dict[str, torch.Tensor]:
+    """Linear head weights from "lin_state_dict" or from a state dict of ft_loss"""
+    if "lin_state_dict" in chkpoint:
+        return chkpoint["lin_state_dict"]
+    head = {k[len("lin."):]: v for k, v in chkpoint.items() if k.startswith("lin.")}
+    assert head, "no linear head weights in the checkpoint, use <name>_best.pt of linear evaluation"
+    return head
+
+
+@torch.no_grad()
+def check_parity(eager: nn.Module, exported: torch.jit.ScriptModule, batch_size: int = 8,
+                 atol: float = 1e-4) -> float:
+    """Largest absolute difference between eager and exported logits, asserted below atol"""
+    eager.eval()
+    x = torch.randn(batch_size, 1, 3000)
+    diff = (eager(x) - exported(x)).abs().max().item()
+    assert diff <= atol, f"exported module differs from eager mode by {diff}"
+    return diff
+
+
+def export(chkpoint_pth: str, out_pth: str, head_pth: Optional[str] = None,
+           optimize: bool = True, atol: float = 1e-4) -> float:
+    chkpoint = torch.load(chkpoint_pth, map_location="cpu")
+    head_chkpoint = chkpoint if head_pth is None else torch.load(head_pth, map_location="cpu")
+
+    eeg_encoder = encoder()
+    eeg_encoder.load_state_dict(chkpoint["eeg_model_state_dict"])
+    lin = nn.Linear(256, len(STAGES))
+    lin.load_state_dict(load_head(head_chkpoint))
+    model = scoring_model(eeg_encoder, lin).eval()
+
+    exported = torch.jit.freeze(torch.jit.script(model))
+    if optimize:
+        exported = torch.jit.optimize_for_inference(exported)
+
+    metadata = {
+        "input_shape": [-1, 1, 3000],
+        "input_dtype": "float32",
+        "sampling_rate": 100,
+        "epoch_seconds": 30,
+        "output": "logits",
+        "classes": STAGES,
+        "method": os.path.basename(os.path.dirname(os.path.abspath(__file__))),
+        "checkpoint": os.path.basename(chkpoint_pth),
+        "torch_version": torch.__version__,
+    }
+    torch.jit.save(exported, out_pth, _extra_files={METADATA: json.dumps(metadata)})
+
+    # parity of the artifact as it will be loaded on the scoring nodes, against the
+    # linear evaluation model the head was trained in
+    reference = ft_loss(chkpoint_pth, Config(), "cpu")
+    reference.lin.load_state_dict(load_head(head_chkpoint))
+    loaded = torch.jit.load(out_pth, map_location="cpu")
+    return check_parity(reference, loaded, atol=atol)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Export encoder + linear head to TorchScript")
+    parser.add_argument("--chkpoint", type=str, required=True,
+                        help="<name>_best.pt of a pretraining run, with the encoder and linear head")
+    parser.add_argument("--head", type=str, default=None,
+                        help="Checkpoint with lin_state_dict, if not in --chkpoint")
+    parser.add_argument("--out", type=str, default="./scoring_model.pt")
+    parser.add_argument("--no_optimize", action="store_true",
+                        help="Skip optimize_for_inference, keep only the frozen graph")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    diff = export(args.chkpoint, args.out, args.head, not args.no_optimize, args.atol)
+    print(f"Exported {args.out}, max abs difference to eager mode: {diff:.2e}")
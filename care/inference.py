@@ -0,0 +1,283 @@
+"""Whole-night hypnogram inference with a trained encoder and linear head.
+
+Every 30 s epoch of a night is encoded exactly once, in large batches, and scored by the
+linear head trained during linear evaluation (<name>_best.pt holds both). With the context
+transformer and a head trained on its features (saved by context_head.py), the windows
+centred on each epoch are built as views of those per-epoch embeddings instead of
+re-encoding the epochs of every window. Scores are streamed out in chunks, so long nights
+and large batches of nights run in bounded memory.
+
+This file can also be imported as a module and contains the following:
+
+    * load_night - Loads the epochs of a night from an npz record or an array.
+    * hypnogram_engine - Scores whole nights epoch by epoch.
+    * online_scorer - Scores epochs one at a time as they are recorded.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import argparse
+import os
+from collections import deque
+from typing import Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from models.model import encoder
+from models.tfr import Transformer
+
+EPOCH_SAMPLES = 3000
+STAGES = ["Wake", "N1", "N2", "N3", "REM"]
+
+
+def load_night(night: Union[str, np.ndarray]) -> np.ndarray:
+    """(N, 1, 3000) float32 epochs of a night.
+
+    night is the path of an npz record written by preprocessing/* (its "windows"), or an
+    array of shape (N, C, 3000), (N, 3000) or a continuous 1D signal of N * 3000 samples.
+    Only the first channel is kept, as in training.
+    """
+    if isinstance(night, str):
+        with np.load(night) as rec:
+            night = rec["windows"]
+    x = np.asarray(night, dtype=np.float32)
+    if x.ndim == 1:
+        assert x.shape[0] % EPOCH_SAMPLES == 0, "signal is not a whole number of epochs"
+        x = x.reshape(-1, EPOCH_SAMPLES)
+    if x.ndim == 2:
+        x = x[:, None, :]
+    return x[:, :1, :]
+
+
+class hypnogram_engine(object):
+    """
+    Class for whole-night sleep staging
+
+    Attributes:
+    -----------
+        eeg_encoder: nn.Module
+            encoder mapping (B, 1, 3000) epochs to (B, 256) features
+        head: nn.Module
+            classifier mapping features to the 5 sleep stages
+        device: torch.device, optional
+            device the models run on
+        batch_size: int, optional
+            epochs per encoder call and windows per transformer call
+        tfmr: Transformer, optional
+            context transformer, the head then scores the context feature of the window
+            centred on each epoch instead of the epoch feature. The head must have been
+            trained on these features, as context_head.py does
+        epoch_len: int, optional
+            context window length in epochs, edges are padded by repeating the first
+            and last epoch
+
+    Methods:
+    --------
+        embed: np.ndarray -> torch.Tensor
+            per-epoch features, every epoch encoded once
+        features: np.ndarray -> iterator of (int, torch.Tensor)
+            start epoch and head inputs of consecutive chunks
+        stream: np.ndarray -> iterator of (int, np.ndarray)
+            start epoch and class probabilities of consecutive chunks
+        score: np.ndarray or str -> np.ndarray, np.ndarray
+            hypnogram and class probabilities of a whole night
+
+    """
+
+    def __init__(
+        self,
+        eeg_encoder: nn.Module,
+        head: nn.Module,
+        device: Optional[torch.device] = None,
+        batch_size: int = 1024,
+        tfmr: Optional[nn.Module] = None,
+        epoch_len: int = 7,
+    ):
+        self.device = device or torch.device(
+            "cuda" if torch.cuda.is_available() else "cpu")
+        self.eeg_encoder = eeg_encoder.to(self.device).eval()
+        self.head = head.to(self.device).eval()
+        self.tfmr = None if tfmr is None else tfmr.to(self.device).eval()
+        self.batch_size = batch_size
+        self.half_window = epoch_len // 2
+
+    @classmethod
+    def from_checkpoint(
+        cls,
+        chkpoint_pth: str,
+        head_pth: Optional[str] = None,
+        **kwargs,
+    ):
+        """Builds the engine from saved weights.
+
+        chkpoint_pth holds "eeg_model_state_dict", and "lin_state_dict" unless head_pth
+        is given. <name>_best.pt, written by the linear evaluation during pretraining,
+        holds the encoder and the head of its best fold. head_pth is a checkpoint with
+        "lin_state_dict" or a state dict of ft_loss. A checkpoint of context_head.py also
+        holds "tfmr_state_dict" and the head trained on its features, the engine then
+        scores context windows of its epoch_len.
+        """
+        chkpoint = torch.load(chkpoint_pth, map_location="cpu")
+        eeg_encoder = encoder()
+        eeg_encoder.load_state_dict(chkpoint["eeg_model_state_dict"])
+
+        if "tfmr_state_dict" in chkpoint:
+            assert head_pth is None, "a context checkpoint holds the head trained on its features"
+            tfmr = Transformer(256, 4, 4, 256, dropout=0.1, backend=chkpoint["attn_backend"])
+            tfmr.load_state_dict(chkpoint["tfmr_state_dict"])
+            kwargs.setdefault("tfmr", tfmr)
+            kwargs.setdefault("epoch_len", chkpoint["epoch_len"])
+
+        head_state = chkpoint if head_pth is None else torch.load(head_pth, map_location="cpu")
+        if "lin_state_dict" in head_state:
+            head_state = head_state["lin_state_dict"]
+        else:
+            head_state = {k[len("lin."):]: v for k, v in head_state.items()
+                          if k.startswith("lin.")}
+        head = nn.Linear(256, len(STAGES))
+        head.load_state_dict(head_state)
+        return cls(eeg_encoder, head, **kwargs)
+
+    @torch.inference_mode()
+    def embed(self, x: np.ndarray) -> torch.Tensor:
+        feats = []
+        for start in range(0, x.shape[0], self.batch_size):
+            batch = torch.from_numpy(np.ascontiguousarray(x[start:start + self.batch_size]))
+            feats.append(self.eeg_encoder(batch.to(self.device)).float())
+        return torch.cat(feats)
+
+    def _context_windows(self, feats: torch.Tensor) -> torch.Tensor:
+        # (N, epoch_len, 256) views of the edge padded per-epoch features
+        h = self.half_window
+        padded = torch.cat([feats[:1].expand(h, -1), feats, feats[-1:].expand(h, -1)])
+        return padded.unfold(0, 2 * h + 1, 1).transpose(1, 2)
+
+    @torch.inference_mode()
+    def features(self, x: np.ndarray) -> Iterator[Tuple[int, torch.Tensor]]:
+        feats = self.embed(x)
+        windows = None if self.tfmr is None else self._context_windows(feats)
+        for start in range(0, feats.shape[0], self.batch_size):
+            if windows is None:
+                yield start, feats[start:start + self.batch_size]
+            else:
+                yield start, self.tfmr(windows[start:start + self.batch_size])
+
+    @torch.inference_mode()
+    def stream(self, x: np.ndarray) -> Iterator[Tuple[int, np.ndarray]]:
+        for start, batch in self.features(x):
+            probs = torch.softmax(self.head(batch).float(), dim=-1)
+            yield start, probs.cpu().numpy()
+
+    def score(self, night: Union[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        x = load_night(night)
+        probs = np.concatenate([p for _, p in self.stream(x)])
+        return probs.argmax(axis=-1), probs
+
+
+class online_scorer(object):
+    """
+    Class for real-time scoring of epochs as they arrive
+
+    Only the new epoch is encoded per tick and the last 2 * (epoch_len // 2) + 1
+    embeddings are kept in a rolling buffer, so time and memory per epoch stay constant
+    over a session. Without a context transformer every score is final right away. With
+    one, each epoch gets a provisional score from its window with the missing future
+    padded by the latest epoch, and a revised score epoch_len // 2 epochs later once its
+    full window has arrived. The revised scores equal hypnogram_engine on the whole night.
+
+    Attributes:
+    -----------
+        engine: hypnogram_engine
+            encoder, head, context transformer and device to score with
+
+    Methods:
+    --------
+        from_checkpoint: str -> online_scorer
+            scorer of the engine built from saved weights
+        push: np.ndarray -> (int, int, np.ndarray), (int, int, np.ndarray) or None
+            encodes a new (3000,) epoch and returns its provisional score and the
+            revised score of the epoch whose context just completed
+        flush: -> list of (int, int, np.ndarray)
+            revised scores of the last epochs at the end of the session
+
+    """
+
+    def __init__(self, engine: hypnogram_engine):
+        self.engine = engine
+        self.half_window = engine.half_window if engine.tfmr is not None else 0
+        self.feats = deque(maxlen=2 * self.half_window + 1)
+        self.n_epochs = 0
+
+    @classmethod
+    def from_checkpoint(cls, chkpoint_pth: str, head_pth: Optional[str] = None, **kwargs):
+        """Scorer of hypnogram_engine.from_checkpoint, with context for a context_head.py checkpoint"""
+        return cls(hypnogram_engine.from_checkpoint(chkpoint_pth, head_pth, **kwargs))
+
+    def _window(self, centre: int) -> torch.Tensor:
+        # absolute epochs centre - h .. centre + h, clipped to the epochs seen so far
+        first = self.n_epochs - len(self.feats)
+        idx = np.clip(np.arange(centre - self.half_window, centre + self.half_window + 1),
+                      0, self.n_epochs - 1) - first
+        return torch.stack([self.feats[i] for i in idx])
+
+    @torch.inference_mode()
+    def _score(self, centres: List[int]) -> List[Tuple[int, int, np.ndarray]]:
+        if self.engine.tfmr is None:
+            batch = torch.stack([self.feats[-1] for _ in centres])
+        else:
+            batch = self.engine.tfmr(torch.stack([self._window(c) for c in centres]))
+        probs = torch.softmax(self.engine.head(batch).float(), dim=-1).cpu().numpy()
+        return [(c, int(p.argmax()), p) for c, p in zip(centres, probs)]
+
+    @torch.inference_mode()
+    def push(self, epoch: np.ndarray):
+        x = torch.as_tensor(np.asarray(epoch, dtype=np.float32).reshape(1, 1, -1))
+        self.feats.append(self.engine.eeg_encoder(x.to(self.engine.device)).float()[0])
+        self.n_epochs += 1
+
+        current = self.n_epochs - 1
+        if self.half_window == 0:
+            return self._score([current])[0], None
+
+        completed = current - self.half_window
+        if completed < 0:
+            return self._score([current])[0], None
+        provisional, revised = self._score([current, completed])
+        return provisional, revised
+
+    def flush(self) -> List[Tuple[int, int, np.ndarray]]:
+        """Scores the epochs still waiting for context, padding the future with the last epoch"""
+        start = max(self.n_epochs - self.half_window, 0)
+        centres = list(range(start, self.n_epochs))
+        if self.half_window == 0 or not centres:
+            return []
+        return self._score(centres)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Score whole nights into hypnograms")
+    parser.add_argument("nights", nargs="+", help="npz records or .npy arrays")
+    parser.add_argument("--chkpoint", type=str, required=True,
+                        help="<name>_best.pt of a pretraining run, or a context_head.py checkpoint")
+    parser.add_argument("--head", type=str, default=None,
+                        help="Checkpoint with lin_state_dict, if not in --chkpoint (<name>_best.pt has it)")
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--out_dir", type=str, default="./hypnograms")
+    args = parser.parse_args()
+
+    engine = hypnogram_engine.from_checkpoint(args.chkpoint,
+                                              args.head,
+                                              batch_size=args.batch_size)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for night in args.nights:
+        x = np.load(night) if night.endswith(".npy") else night
+        stages, probs = engine.score(x)
+        name = os.path.splitext(os.path.basename(night))[0]
+        np.savez(os.path.join(args.out_dir, name + "_hypnogram.npz"),
+                 stages=stages,
+                 probs=probs)
+        print(f"{name}: {len(stages)} epochs")
@@ -41,10 +41,22 @@ class FeedForward(nn.Module):
 
 
 class Attention(nn.Module):
-    def __init__(self, dim, heads=8, dropout=0.):
+    """Multi-head self-attention.
+
+    backend "math" is the reference implementation with explicit einsum and softmax,
+    "sdpa" routes the packed q, k, v through F.scaled_dot_product_attention, which picks
+    a fused kernel when one is available. Both share the same parameters and the same
+    dim ** -0.5 scaling, so checkpoints and outputs carry over between them.
+    """
+
+    backends = ("math", "sdpa")
+
+    def __init__(self, dim, heads=8, dropout=0., backend="math"):
         super().__init__()
+        assert backend in self.backends, f"unknown attention backend {backend}"
         self.heads = heads
         self.scale = dim ** -0.5
+        self.backend = backend
 
         self.to_qkv = nn.Linear(dim, dim * 3, bias=False)
         self.to_out = nn.Sequential(
@@ -52,7 +64,17 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         )
 
+    @staticmethod
+    def _pair_mask(mask):
+        mask = F.pad(mask.flatten(1), (1, 0), value=True)
+        return mask[:, None, :] * mask[:, :, None]
+
     def forward(self, x, mask=None):
+        if self.backend == "sdpa":
+            return self._forward_sdpa(x, mask)
+        return self._forward_math(x, mask)
+
+    def _forward_math(self, x, mask=None):
         b, n, _, h = *x.shape, self.heads
         qkv = self.to_qkv(x).chunk(3, dim=-1)
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), qkv)
@@ -60,10 +82,9 @@ class Attention(nn.Module):
         dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
 
         if mask is not None:
-            mask = F.pad(mask.flatten(1), (1, 0), value=True)
+            mask = self._pair_mask(mask)
             assert mask.shape[-1] == dots.shape[-1], 'mask has incorrect dimensions'
-            mask = mask[:, None, :] * mask[:, :, None]
-            dots.masked_fill_(~mask, float('-inf'))
+            dots.masked_fill_(~mask[:, None], float('-inf'))
             del mask
 
         attn = dots.softmax(dim=-1)
@@ -73,14 +94,31 @@ class Attention(nn.Module):
         out = self.to_out(out)
         return out
 
+    def _forward_sdpa(self, x, mask=None):
+        b, n, dim = x.shape
+        h = self.heads
+        # packed projection, split into (3, b, h, n, d) without copies
+        q, k, v = self.to_qkv(x).view(b, n, 3, h, dim // h).permute(2, 0, 3, 1, 4).unbind(0)
+
+        attn_mask = None
+        if mask is not None:
+            attn_mask = self._pair_mask(mask)
+            assert attn_mask.shape[-1] == n, 'mask has incorrect dimensions'
+            attn_mask = attn_mask[:, None]
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=self.scale)
+        out = out.transpose(1, 2).reshape(b, n, dim)
+        out = self.to_out(out)
+        return out
+
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, mlp_dim, dropout=0.4):
+    def __init__(self, dim, depth, heads, mlp_dim, dropout=0.4, backend="math"):
         super().__init__()
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
-                Residual(PreNorm(dim, Attention(dim, heads=heads, dropout=dropout))),
+                Residual(PreNorm(dim, Attention(dim, heads=heads, dropout=dropout, backend=backend))),
                 Residual(PreNorm(dim, FeedForward(dim, mlp_dim, dropout=dropout)))
             ]))
 
@@ -96,5 +134,3 @@ class Transformer(nn.Module):
             x = ff(x)
         x = torch.mean(x,dim=1)
         return x
-
-
@@ -9,41 +9,65 @@ This file can also be imported as a module and contains the following:
     * Load_Dataset - Loads the dataset and applies the augmentations.
     * data_generator - Generates a dataloader for the dataset.
     * cross_data_generator - Generates a k-fold dataloader for the given dataset. 
+    * subject_store - Loads the linear evaluation records once into shared arrays.
 """
 __author__ = "Likith Reddy, Vamsi Kumar"
 __version__ = "1.0.0"
 __email__ = "likith012@gmail.com, vamsi81523@gmail.com"
 
 
+import os
 import numpy as np
-import copy
 import torch
 
 from torch.utils.data import Dataset
-from utils.augmentations import augment
+from utils.augmentations import augment_batch
 
 class pretext_data(Dataset):
+    """Pretext windows sliced out of packed, memory-mapped recording shards.
+
+    filepath is the pretext directory written by preprocessing/shhs/generate.py: one
+    (n_epochs, channels, 3000) .npy shard per recording and an index.npz with the shard
+    id and centre epoch of every window.
+    """
+
+    max_open_shards = 512
 
     def __init__(self, config,filepath):
 
         self.file_path = filepath
-        self.idx = np.array(range(len(self.file_path)))
         self.config = config
+        index = np.load(os.path.join(filepath, 'index.npz'))
+        self.shards = [os.path.join(filepath, f) for f in index['shards']]
+        self.shard_ids = index['shard_ids']
+        self.centres = index['centres']
+        self.idx = np.array(range(len(self.centres)))
+        self.half_window = config.epoch_len // 2
+        assert self.half_window <= int(index['half_window']), 'epoch_len is wider than the generated windows'
+        self._memmaps = {}
 
     def __len__(self):
-        return len(self.file_path)
+        return len(self.centres)
+
+    def _shard(self, shard_id):
+        # mapped lazily so that every DataLoader worker opens its own memmaps
+        if shard_id not in self._memmaps:
+            if len(self._memmaps) >= self.max_open_shards:
+                self._memmaps.clear()
+            self._memmaps[shard_id] = np.load(self.shards[shard_id], mmap_mode='r')
+        return self._memmaps[shard_id]
 
     def __getitem__(self, index):
 
-        path = self.file_path[index]
-        data = np.load(path)
-        pos = torch.tensor(data['pos'][:, :1, :]) #(7, 2, 3000)
-        anc = copy.deepcopy(pos)
+        data = self._shard(self.shard_ids[index])
+        centre = self.centres[index]
+        pos = data[centre - self.half_window : centre + self.half_window + 1, :1, :] # memmap view (7, 1, 3000)
+        if self.config.augment_on_device:
+            return torch.tensor(pos[:, 0, :], dtype=torch.float)  # views are built on the device
 
-        # augment
-        for i in range(pos.shape[0]):
-            pos[i],anc[i] = augment(pos[i],self.config)
-        return pos[:,0,:],anc[:,0,:]
+        # augment all epochs in one vectorized pass
+        weak, strong = augment_batch(pos[None], self.config)
+        return torch.from_numpy(weak[0, :, 0, :]), torch.from_numpy(strong[0, :, 0, :])
 
 class train_data(Dataset):
 
@@ -71,14 +95,29 @@ class TuneDataset(Dataset):
 
     def __getitem__(self, index):
 
-        X = self.X[index,:1,:]
-        y =  self.y[index]
+        if self.index is not None:
+            index = self.index[index]
+        X = np.array(self.X[index, :1, :])
+        y = self.y[index]
         return X, y
 
     def __len__(self):
+        if self.index is not None:
+            return self.index.shape[0]
         return self.X.shape[0]
 
     def _add_subjects(self):
+        # Records of one subject_store: index its shared arrays instead of copying
+        stores = set(id(subject.store) if isinstance(subject, store_record) else None
+                     for subject in self.subjects)
+        if len(stores) == 1 and None not in stores:
+            self.X = self.subjects[0].store.X
+            self.y = self.subjects[0].store.y
+            self.index = np.concatenate(
+                [np.arange(subject.start, subject.stop) for subject in self.subjects])
+            return
+
+        self.index = None
         self.X = []
         self.y = []
         for subject in self.subjects:
@@ -87,3 +126,93 @@ class TuneDataset(Dataset):
         self.X = np.concatenate(self.X, axis=0)
         self.y = np.concatenate(self.y, axis=0)
 
+
+class store_record(object):
+    """View of a single record in a subject_store, indexed like the npz record"""
+
+    def __init__(self, store, key, start, stop):
+        self.store = store
+        self.key = key
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, name):
+        if name == "windows":
+            return self.store.X[self.start:self.stop]
+        if name == "y":
+            return self.store.y[self.start:self.stop]
+        raise KeyError(name)
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+class subject_store(object):
+    """Linear evaluation records decompressed once into shared arrays.
+
+    Every record is read a single time into one (N, C, 3000) window array and one label
+    array and grouped into subjects by its description, in the order of files. Subjects
+    are lists of store_record views, so a TuneDataset over any fold indexes the shared
+    arrays instead of concatenating copies. With cache_path the arrays are written as
+    .npy once and memory mapped afterwards, so DataLoader workers and evaluation
+    processes share the same pages. The cache is rebuilt unless every record has the
+    same key, mtime and size as when it was written.
+    """
+
+    def __init__(self, files, cache_path=None):
+        keys = [os.path.splitext(os.path.basename(f))[0] for f in files]
+        stats = np.array([(os.stat(f).st_mtime, os.stat(f).st_size) for f in files],
+                         dtype=np.float64).reshape(-1, 2)
+        index_path = None if cache_path is None else os.path.join(cache_path, "index.npz")
+
+        if index_path is not None and os.path.exists(index_path):
+            index = np.load(index_path)
+            if (list(index["keys"]) != keys or "stats" not in index.files
+                    or not np.array_equal(index["stats"], stats)):
+                index = None
+        else:
+            index = None
+
+        if index is not None:
+            self.X = np.load(os.path.join(cache_path, "windows.npy"), mmap_mode="r")
+            self.y = np.load(os.path.join(cache_path, "y.npy"), mmap_mode="r")
+            descriptions, offsets = list(index["descriptions"]), index["offsets"]
+        else:
+            windows, ys, descriptions = [], [], []
+            for f in files:
+                with np.load(f) as rec:
+                    windows.append(rec["windows"])
+                    ys.append(rec["y"])
+                    descriptions.append(rec["_description"][0])
+            offsets = np.cumsum([0] + [len(y) for y in ys])
+            self.X = np.concatenate(windows, axis=0)
+            self.y = np.concatenate(ys, axis=0)
+            del windows, ys
+            if cache_path is not None:
+                self._save(cache_path, keys, stats, descriptions, offsets)
+
+        subjects = dict()
+        for i, (key, description) in enumerate(zip(keys, descriptions)):
+            rec = store_record(self, key, int(offsets[i]), int(offsets[i + 1]))
+            subjects.setdefault(description, []).append(rec)
+        self.subjects = list(subjects.values())
+
+    def _save(self, cache_path, keys, stats, descriptions, offsets):
+        os.makedirs(cache_path, exist_ok=True)
+        for name, arr in (("windows", self.X), ("y", self.y)):
+            np.save(os.path.join(cache_path, name + ".tmp.npy"), arr)
+            os.replace(os.path.join(cache_path, name + ".tmp.npy"),
+                       os.path.join(cache_path, name + ".npy"))
+        np.savez(os.path.join(cache_path, "index.tmp.npz"),
+                 keys=np.array(keys),
+                 stats=stats,
+                 descriptions=np.array(descriptions),
+                 offsets=offsets)
+        os.replace(os.path.join(cache_path, "index.tmp.npz"),
+                   os.path.join(cache_path, "index.npz"))
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, index):
+        return self.subjects[index]
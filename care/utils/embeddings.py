@@ -0,0 +1,132 @@
+"""Frozen encoder features for linear evaluation.
+
+During linear evaluation the encoder is frozen, so its output for a window never changes
+while the linear head trains. The features of every record are computed once in inference
+mode and reused by all folds and epochs. They are kept in memory, and optionally on disk,
+keyed by the checkpoint digest and the record.
+
+This file can also be imported as a module and contains the following:
+
+    * checkpoint_digest - Hashes the contents of a checkpoint file.
+    * record_key - Stable identifier of a record.
+    * embedding_cache - Computes and caches the encoder features of records.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+
+import os
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+_memory: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]] = {}
+
+
+def checkpoint_digest(chkpoint_pth: str) -> str:
+    sha = hashlib.sha1()
+    with open(chkpoint_pth, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+def record_key(record) -> str:
+    """File name of an npz record or subject_store record, or a digest of its windows"""
+    if getattr(record, "key", None) is not None:
+        return record.key
+    filename = getattr(getattr(record, "zip", None), "filename", None)
+    if filename is not None:
+        return os.path.splitext(os.path.basename(filename))[0]
+    windows = np.ascontiguousarray(record["windows"])
+    return hashlib.sha1(windows.tobytes()).hexdigest()[:16]
+
+
+class embedding_cache(object):
+    """
+    Class for caching frozen encoder features
+
+    Attributes:
+    -----------
+        encoder: nn.Module
+            frozen encoder mapping (B, 1, 3000) windows to (B, 256) features
+        chkpoint_pth: str
+            checkpoint the encoder weights were loaded from
+        device: torch.device
+            device the encoder runs on
+        cache_dir: str, optional
+            directory for on-disk features, features are only kept in memory if None
+        batch_size: int, optional
+            windows per encoder call
+
+    Methods:
+    --------
+        record_features: record -> np.ndarray, np.ndarray
+            features and labels of a single record
+        features: list of records -> torch.Tensor, torch.Tensor
+            concatenated features and labels of the records
+
+    """
+
+    def __init__(
+        self,
+        encoder: nn.Module,
+        chkpoint_pth: str,
+        device: torch.device,
+        cache_dir: Optional[str] = None,
+        batch_size: int = 512,
+    ):
+        self.encoder = encoder
+        self.device = device
+        self.batch_size = batch_size
+        self.digest = checkpoint_digest(chkpoint_pth)
+        self.cache_dir = None
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir, self.digest)
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Features of older checkpoints are never asked for again
+        for key in [k for k in _memory if k[0] != self.digest]:
+            del _memory[key]
+
+    @torch.inference_mode()
+    def _encode(self, windows: np.ndarray) -> np.ndarray:
+        was_training = self.encoder.training
+        self.encoder.eval()
+        feats = []
+        for start in range(0, windows.shape[0], self.batch_size):
+            x = torch.from_numpy(
+                np.ascontiguousarray(windows[start:start + self.batch_size, :1, :],
+                                     dtype=np.float32))
+            feats.append(self.encoder(x.to(self.device)).float().cpu())
+        self.encoder.train(was_training)
+        return torch.cat(feats).numpy()
+
+    def record_features(self, record) -> Tuple[np.ndarray, np.ndarray]:
+        key = (self.digest, record_key(record))
+        if key in _memory:
+            return _memory[key]
+
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key[1] + ".npz")
+            if os.path.exists(path):
+                cached = np.load(path)
+                _memory[key] = (cached["x"], cached["y"])
+                return _memory[key]
+
+        x, y = self._encode(record["windows"]), np.asarray(record["y"])
+        if path is not None:
+            tmp = path + ".tmp.npz"
+            np.savez(tmp, x=x, y=y)
+            os.replace(tmp, path)
+        _memory[key] = (x, y)
+        return x, y
+
+    def features(self, records: List) -> Tuple[torch.Tensor, torch.Tensor]:
+        xs, ys = zip(*[self.record_features(rec) for rec in records])
+        return torch.from_numpy(np.concatenate(xs)), torch.from_numpy(np.concatenate(ys))
@@ -1,6 +1,8 @@
 import os
 import time, math
 import torch
+import multiprocessing as mp
+from contextlib import contextmanager
 import torch.nn as nn
 import numpy as np
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -11,11 +13,47 @@ from models.model import contrast_loss, ft_loss
 from sklearn.metrics import ConfusionMatrixDisplay, balanced_accuracy_score
 from sklearn.model_selection import KFold
 from utils.dataloader import TuneDataset
-from torch.utils.data import DataLoader
+from utils.embeddings import embedding_cache
+from utils.augmentations import augment_torch
+from utils.momentum import momentum_updater
+from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 from torch.cuda.amp import GradScaler
 
 
+# Fold state shared with the forked k-fold workers, set only while the pool runs
+_kfold_state = None
+
+
+@contextmanager
+def _fold_rng(seed):
+    """Seeds torch and numpy for one fold and restores the caller's RNG state afterwards.
+
+    Every fold starts from kfold_seed + fold, so its result does not depend on whether it
+    runs in the trainer or in a forked worker, which inherits the trainer's RNG state.
+    """
+    np_state = np.random.get_state()
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        try:
+            yield
+        finally:
+            np.random.set_state(np_state)
+
+
+def _kfold_worker(fold):
+    """Evaluates a single fold inside a forked pool process.
+
+    The child is pinned to one intra-op thread: the trainer has already run multi-threaded
+    OpenMP work before forking, and a forked child that starts its own OpenMP pool deadlocks.
+    """
+    trainer, folds = _kfold_state
+    torch.set_num_threads(1)
+    with _fold_rng(trainer.config.kfold_seed + fold):
+        return trainer.ft_fun(*folds[fold])
+
+
 class sleep_pretrain(nn.Module):
 
     def __init__(self, config, name, dataloader, test_subjects, wandb_logger):
@@ -47,13 +85,34 @@ class sleep_pretrain(nn.Module):
         self.max_kappa = 0
         self.max_bal_acc = 0
         self.max_acc = 0
-        self.m = 0.9995
+        self.m = config.momentum
+        self.momentum_updater = momentum_updater(
+            [
+                (self.model.model.top_encoder, self.model.model.bot_encoder),
+                (self.model.model.top_tfmr, self.model.model.bot_tfmr),
+                (self.model.model.top_curr_proj, self.model.model.bot_curr_proj),
+                (self.model.model.top_surr_proj, self.model.model.bot_surr_proj),
+            ],
+            m=self.m,
+            m_end=config.momentum_end,
+            total_steps=self.epochs * len(dataloader),
+            update_buffers=config.momentum_buffers,
+        )
 
         self.test_subjects = test_subjects
+        self.eval_chkpoint_pth = os.path.join(config.exp_path, name + ".pt")
+        self.eval_queue_path = config.eval_queue_path or os.path.join(
+            config.exp_path, "eval_queue")
+        # Marks the end of this run only, so a worker never stops on the marker of an
+        # earlier run sharing the queue
+        self.done_pth = os.path.join(self.eval_queue_path, f"DONE_{config.run_id}")
 
     def training_step(self, batch, batch_idx):
-        weak, strong = batch
-        weak, strong = weak.to(self.device), strong.to(self.device)
+        if self.config.augment_on_device:
+            weak, strong = augment_torch(batch.to(self.device), self.config)
+        else:
+            weak, strong = batch
+            weak, strong = weak.to(self.device), strong.to(self.device)
         loss = self.model(weak, strong)
         return loss
 
@@ -84,42 +143,58 @@ class sleep_pretrain(nn.Module):
         )
         return None
 
+    def enqueue_eval(self, epoch):
+        """Snapshots the encoder into the queue consumed by eval_worker.py"""
+        snapshot = {
+            "eeg_model_state_dict": self.model.model.top_encoder.state_dict(),
+            "epoch": epoch,
+        }
+        path = os.path.join(self.eval_queue_path, self.name + f"_epoch{epoch:04d}.pt")
+        torch.save(snapshot, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
     def ft_fun(self, test_subjects_train, test_subjects_test):
 
-        train_dl = DataLoader(
-            TuneDataset(test_subjects_train),
-            batch_size=self.config.batch_size,
-            shuffle=True,
-        )
-        test_dl = DataLoader(
-            TuneDataset(test_subjects_test),
-            batch_size=self.config.batch_size,
-            shuffle=False,
-        )
+        if self.config.cache_embeddings:
+            # sleep_ft builds its loaders from the cached features of the records
+            train_dl, test_dl = None, None
+        else:
+            train_dl = DataLoader(
+                TuneDataset(test_subjects_train),
+                batch_size=self.config.batch_size,
+                shuffle=True,
+            )
+            test_dl = DataLoader(
+                TuneDataset(test_subjects_test),
+                batch_size=self.config.batch_size,
+                shuffle=False,
+            )
         
         sleep_eval = sleep_ft(
-            self.config.exp_path + "/" + self.name + ".pt",
+            self.eval_chkpoint_pth,
             self.config,
             train_dl,
             test_dl,
             self.loggr,
+            train_records=test_subjects_train,
+            valid_records=test_subjects_test,
         )
         f1, kappa, bal_acc, acc = sleep_eval.fit()
 
-        return f1, kappa, bal_acc, acc
+        return f1, kappa, bal_acc, acc, sleep_eval.best_state
 
     def do_kfold(self):
 
         kfold = KFold(n_splits=self.config.splits,
                       shuffle=True,
                       random_state=1234)
-    
+
         k_acc, k_f1, k_kappa, k_bal_acc = 0, 0, 0, 0
         start = time.time()
-    
-        i = 0
+
+        folds = []
         for train_idx, test_idx in kfold.split(self.test_subjects):
-    
+
             test_subjects_train = [self.test_subjects[i] for i in train_idx]
             test_subjects_test = [self.test_subjects[i] for i in test_idx]
             test_subjects_train = [
@@ -128,11 +203,36 @@ class sleep_pretrain(nn.Module):
             test_subjects_test = [
                 rec for sub in test_subjects_test for rec in sub
             ]
-
-            i+=1
-            print(f'Fold: {i}')
-            
-            f1, kappa, bal_acc, acc = self.ft_fun(test_subjects_train, test_subjects_test)
+            folds.append((test_subjects_train, test_subjects_test))
+
+        # Parallel folds are CPU-only: forked workers cannot use the trainer's CUDA context
+        # and a spawn context would have to pickle the trainer with its data and logger
+        workers = min(self.config.kfold_workers, len(folds))
+        if workers > 1 and torch.cuda.is_available():
+            print('kfold_workers is CPU-only, folds run sequentially on the GPU')
+            workers = 1
+        if workers > 1:
+            global _kfold_state
+            print(f'Folds: {len(folds)} on {workers} workers')
+            _kfold_state = (self, folds)
+            try:
+                with mp.get_context("fork").Pool(workers) as pool:
+                    results = pool.map(_kfold_worker, range(len(folds)))
+            finally:
+                _kfold_state = None
+        else:
+            results = []
+            for i, fold in enumerate(folds):
+                print(f'Fold: {i + 1}')
+                with _fold_rng(self.config.kfold_seed + i):
+                    results.append(self.ft_fun(*fold))
+
+        # Merged in fold order, as in the sequential loop. The encoder and linear head
+        # of the best fold are kept for <name>_best.pt, None if no fold scored an F1 above 0
+        scored = [i for i in range(len(results)) if results[i][4] is not None]
+        best_fold = max(scored, key=lambda i: float(results[i][0]), default=None)
+        self.best_fold_state = None if best_fold is None else results[best_fold][4]
+        for f1, kappa, bal_acc, acc, _ in results:
             k_f1 += f1
             k_kappa += kappa
             k_bal_acc += bal_acc
@@ -152,6 +252,10 @@ class sleep_pretrain(nn.Module):
 
         epoch_loss = 0
         scaler = GradScaler()
+        if self.config.async_eval:
+            os.makedirs(self.eval_queue_path, exist_ok=True)
+            if os.path.exists(self.done_pth):
+                os.remove(self.done_pth)
         
         for epoch in range(self.epochs):
             self.current_epoch = epoch
@@ -170,18 +274,8 @@ class sleep_pretrain(nn.Module):
                 scaler.step(self.optimizer)
                 scaler.update()
 
-                for param_q, param_k in zip(self.model.model.top_encoder.parameters(), self.model.model.bot_encoder.parameters()):
-                    param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-
-                for param_q, param_k in zip(self.model.model.top_tfmr.parameters(), self.model.model.bot_tfmr.parameters()):
-                    param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-                
-                for param_q, param_k in zip(self.model.model.top_curr_proj.parameters(), self.model.model.bot_curr_proj.parameters()):
-                    param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-                    
-                for param_q, param_k in zip(self.model.model.top_surr_proj.parameters(), self.model.model.bot_surr_proj.parameters()):
-                    param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
-                    
+                self.momentum_updater.step()
+
                 outputs["loss"].append(loss.detach().item())
 
             epoch_loss = self.training_epoch_end(outputs)
@@ -194,6 +288,10 @@ class sleep_pretrain(nn.Module):
 
             # evaluation step
             if (epoch % 5 == 0) and (epoch > 25):
+                if self.config.async_eval:
+                    self.enqueue_eval(epoch)
+                    continue
+
                 f1, kappa, bal_acc, acc = self.do_kfold()
                 self.loggr.log({
                     'F1': f1,
@@ -210,6 +308,9 @@ class sleep_pretrain(nn.Module):
                         'best_pretrain_epoch': epoch,
                         'f1': f1
                     }   
+                    chkpoint['run_id'] = self.config.run_id
+                    if self.best_fold_state is not None:
+                        chkpoint.update(self.best_fold_state)
                     torch.save(
                         chkpoint,
                         os.path.join(self.config.exp_path,
@@ -219,11 +320,14 @@ class sleep_pretrain(nn.Module):
                         os.path.join(self.config.exp_path, self.name + f'_best.pt'))
                     self.max_f1 = f1
 
+        if self.config.async_eval:
+            open(self.done_pth, "w").close()
 
 
 class sleep_ft(nn.Module):
 
-    def __init__(self, chkpoint_pth, config, train_dl, valid_dl, wandb_logger):
+    def __init__(self, chkpoint_pth, config, train_dl, valid_dl, wandb_logger,
+                 train_records=None, valid_records=None):
         super(sleep_ft, self).__init__()
         self.device = torch.device(
             "cuda" if torch.cuda.is_available() else "cpu")
@@ -237,6 +341,10 @@ class sleep_ft(nn.Module):
         self.criterion = nn.CrossEntropyLoss()
         self.train_ft_dl = train_dl
         self.valid_ft_dl = valid_dl
+        self.head = self.model
+        self.best_state = None
+        if config.cache_embeddings:
+            self.cache_features(chkpoint_pth, train_records, valid_records)
         self.eval_es = config.eval_early_stopping
 
         self.best_loss = torch.tensor(math.inf).to(self.device)
@@ -254,6 +362,31 @@ class sleep_ft(nn.Module):
         )
         self.ft_epoch = config.num_ft_epoch
 
+    def cache_features(self, chkpoint_pth, train_records, valid_records):
+        """Trains the linear head on frozen encoder features computed once per record.
+
+        The loaders are built straight from the cached features, no raw window dataset
+        is built for the records.
+        """
+        cache = embedding_cache(
+            self.model.eeg_encoder,
+            chkpoint_pth,
+            self.device,
+            cache_dir=self.config.embedding_cache_path,
+            batch_size=self.batch_size,
+        )
+        self.head = self.model.lin
+        self.train_ft_dl = DataLoader(
+            TensorDataset(*cache.features(train_records)),
+            batch_size=self.config.batch_size,
+            shuffle=True,
+        )
+        self.valid_ft_dl = DataLoader(
+            TensorDataset(*cache.features(valid_records)),
+            batch_size=self.config.batch_size,
+            shuffle=False,
+        )
+
     def train_dataloader(self):
         return self.train_dl
 
@@ -263,14 +396,14 @@ class sleep_ft(nn.Module):
     def training_step(self, batch, batch_idx):
         data, y = batch
         data, y = data.float().to(self.device), y.long().to(self.device)
-        outs = self.model(data)
+        outs = self.head(data)
         loss = self.criterion(outs, y)
         return loss
 
     def validation_step(self, batch, batch_idx):
         data, y = batch
         data, y = data.float().to(self.device), y.to(self.device)
-        outs = self.model(data)
+        outs = self.head(data)
         loss = self.criterion(outs, y)
         acc = accuracy(outs, y)
         return {
@@ -299,12 +432,22 @@ class sleep_ft(nn.Module):
             #            y_true= epoch_targets.cpu().numpy(), preds= class_preds.numpy(),
             #            class_names= ['Wake', 'N1', 'N2', 'N3', 'REM'])})
             self.max_f1 = f1_sc
+            self.best_state = self.head_state()
             self.max_kappa = kappa
             self.max_bal_acc = bal_acc
             self.max_acc = epoch_acc
 
         return epoch_loss
 
+    def head_state(self):
+        """CPU copies of the encoder and linear head weights, saved to <name>_best.pt"""
+        return {
+            "eeg_model_state_dict": {k: v.detach().cpu().clone()
+                                     for k, v in self.model.eeg_encoder.state_dict().items()},
+            "lin_state_dict": {k: v.detach().cpu().clone()
+                               for k, v in self.model.lin.state_dict().items()},
+        }
+
     def on_train_end(self):
         return self.max_f1, self.max_kappa, self.max_bal_acc, self.max_acc
 
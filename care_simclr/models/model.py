@@ -16,6 +16,8 @@ class attention(nn.Module):
     --------
         forward: torch.Tensor -> torch.Tensor
             forward pass of the attention module
+        inference: torch.Tensor -> torch.Tensor
+            forward pass without autograd state
 
     """
     
@@ -27,16 +29,17 @@ class attention(nn.Module):
         self.scale = self.att_dim ** -0.5
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        e = torch.matmul(x, self.W)
-        e = torch.matmul(torch.tanh(e), self.V)
-        e = e * self.scale
-        n1 = torch.exp(e)
-        n2 = torch.sum(torch.exp(e), 1, keepdim=True)
-        alpha = torch.div(n1, n2)
-        x = torch.sum(torch.mul(alpha, x), 1)
+        # x: (B, C, T), scores over T from a single softmax, computed in float32 so
+        # large scores cannot overflow under autocast
+        e = torch.matmul(torch.tanh(torch.matmul(x.transpose(1, 2), self.W)), self.V)
+        alpha = torch.softmax(e.float() * self.scale, dim=1)  # B, T, 1
+        x = torch.bmm(x, alpha.to(x.dtype)).squeeze(-1)  # B, C
         return x
 
+    @torch.inference_mode()
+    def inference(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x)
+
 
 class encoder(nn.Module):
     """
@@ -59,7 +62,7 @@ class encoder(nn.Module):
         self.model = BaseNet()
         self.attention = attention()
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.model(x)
         x = self.attention(x)
         return x
@@ -125,26 +128,46 @@ class sleep_model(nn.Module):
         self.surr_strong_pj = projection_head(config)
 
         self.config = config
-        self.tfmr = Transformer(256, 4, 4, 256, dropout=0.1)
+        self.tfmr = Transformer(256, 4, 4, 256, dropout=0.1, backend=config.attn_backend)
+
+    def encode_epochs(self, encoder: nn.Module, data: torch.Tensor) -> torch.Tensor:
+        """Encodes every epoch of (B, epoch_len, 3000) data with a single encoder call.
+
+        Returns the (B, epoch_len, 256) features. In train mode BatchNorm normalizes over
+        all B * epoch_len windows, use check_encode_epochs to compare against the
+        per-epoch loop.
+        """
+
+        batch_size, epoch_len, _ = data.shape
+        feats = encoder(data.reshape(batch_size * epoch_len, 1, -1))
+        return feats.view(batch_size, epoch_len, -1)
+
+    @torch.no_grad()
+    def check_encode_epochs(self, data: torch.Tensor, atol: float = 1e-5) -> bool:
+        """Checks in eval mode that encode_epochs matches encoding one epoch at a time."""
+
+        was_training = self.training
+        self.eval()
+        data = data.float()
+        encoder = self.eeg_encoder
+        folded = self.encode_epochs(encoder, data)
+        looped = torch.stack(
+            [encoder(data[:, i : i + 1, :]) for i in range(data.shape[1])], dim=1
+        )
+        self.train(was_training)
+        return torch.allclose(folded, looped, atol=atol)
 
     def forward(self, weak_dat: torch.Tensor, strong_dat: torch.Tensor):
 
         weak_eeg_dat = weak_dat.float()
         strong_eeg_dat = strong_dat.float()
 
-        weak_surr_feats = []
-        strong_surr_feats = []
-
-        for i in range(self.config.epoch_len):
-            weak_surr_feats.append(self.eeg_encoder(weak_eeg_dat[:, i : i + 1, :]))
-            strong_surr_feats.append(self.eeg_encoder(strong_eeg_dat[:, i : i + 1, :]))
+        weak_surr_feats = self.encode_epochs(self.eeg_encoder, weak_eeg_dat)
+        strong_surr_feats = self.encode_epochs(self.eeg_encoder, strong_eeg_dat)
 
         ep = torch.randint(self.config.epoch_len, (1,)).item()
-        weak_curr_feats = weak_surr_feats[ep]
-        strong_curr_feats = strong_surr_feats[ep]
-
-        weak_surr_feats = torch.stack(weak_surr_feats, dim=1)
-        strong_surr_feats = torch.stack(strong_surr_feats, dim=1)
+        weak_curr_feats = weak_surr_feats[:, ep]
+        strong_curr_feats = strong_surr_feats[:, ep]
 
         weak_surr_feats = self.tfmr(weak_surr_feats)
         strong_surr_feats = self.tfmr(strong_surr_feats)
@@ -171,6 +194,8 @@ class contrast_loss(nn.Module):
 
     Methods:
     --------
+        fused_loss: torch.Tensor,torch.Tensor,torch.Tensor,torch.Tensor -> torch.Tensor
+            the four pairwise contrastive losses as a 2x2 tensor
         forward: torch.Tensor,torch.Tensor-> torch.Tensor,float,float,float,float
 
     """
@@ -204,6 +229,40 @@ class contrast_loss(nn.Module):
         loss = -torch.log(pos / neg).mean()
         return loss
 
+    def fused_loss(
+        self,
+        top_curr: torch.Tensor,
+        top_surr: torch.Tensor,
+        bot_curr: torch.Tensor,
+        bot_surr: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        All four pairwise losses from a shared similarity computation, equal to
+        [[loss(top_curr, bot_curr), loss(top_curr, bot_surr)],
+         [loss(top_surr, bot_curr), loss(top_surr, bot_surr)]]
+        """
+        top = F.normalize(torch.stack([top_curr, top_surr]), p=2, dim=-1)  # 2, B, D
+        bot = F.normalize(torch.stack([bot_curr, bot_surr]), p=2, dim=-1)  # 2, B, D
+        B = top.shape[1]
+
+        # Negatives within each view, the sample itself excluded
+        eye = torch.eye(B, dtype=torch.bool, device=top.device)
+        top_sim = torch.bmm(top, top.transpose(1, 2)).float() / self.T  # 2, B, B
+        bot_sim = torch.bmm(bot, bot.transpose(1, 2)).float() / self.T  # 2, B, B
+        top_lse = top_sim.masked_fill(eye, float("-inf")).logsumexp(dim=-1)  # 2, B
+        bot_lse = bot_sim.masked_fill(eye, float("-inf")).logsumexp(dim=-1)  # 2, B
+
+        # Cross-view similarities, the diagonal holds the positives
+        cross = torch.matmul(top, bot.reshape(2 * B, -1).t()).float() / self.T
+        cross = cross.view(2, B, 2, B)  # top, top sample, bot, bot sample
+        top_cross_lse = cross.logsumexp(dim=-1)  # 2, B, 2
+        bot_cross_lse = cross.logsumexp(dim=1).transpose(1, 2)  # 2, B, 2
+        pos = torch.einsum("tid,bid->tib", top, bot).float() / self.T  # 2, B, 2
+
+        top_loss = torch.logaddexp(top_lse.unsqueeze(-1), top_cross_lse) - pos
+        bot_loss = torch.logaddexp(bot_lse.t().unsqueeze(0), bot_cross_lse) - pos
+        return (top_loss.mean(dim=1) + bot_loss.mean(dim=1)) / 2  # 2, 2
+
     def forward(
         self, weak: torch.Tensor, strong: torch.Tensor
     ):
@@ -215,11 +274,9 @@ class contrast_loss(nn.Module):
             bot_surr,
         ) = self.model(weak, strong)
 
-        l1 = self.loss(top_curr, bot_curr)
-        l2 = self.loss(top_surr, bot_surr)
-
-        l3 = self.loss(top_curr, bot_surr)
-        l4 = self.loss(top_surr, bot_curr)
+        losses = self.fused_loss(top_curr, top_surr, bot_curr, bot_surr)
+        l1, l2 = losses[0, 0], losses[1, 1]
+        l3, l4 = losses[0, 1], losses[1, 0]
 
         tot_loss = (l1 + l2) + self.config.lambda1 * (l3 + l4)
 
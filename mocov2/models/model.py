@@ -16,6 +16,8 @@ class attention(nn.Module):
     --------
         forward: torch.Tensor -> torch.Tensor
             forward pass of the attention module
+        inference: torch.Tensor -> torch.Tensor
+            forward pass without autograd state
 
     """
 
@@ -27,16 +29,17 @@ class attention(nn.Module):
         self.scale = self.att_dim**-0.5
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        e = torch.matmul(x, self.W)
-        e = torch.matmul(torch.tanh(e), self.V)
-        e = e * self.scale
-        n1 = torch.exp(e)
-        n2 = torch.sum(torch.exp(e), 1, keepdim=True)
-        alpha = torch.div(n1, n2)
-        x = torch.sum(torch.mul(alpha, x), 1)
+        # x: (B, C, T), scores over T from a single softmax, computed in float32 so
+        # large scores cannot overflow under autocast
+        e = torch.matmul(torch.tanh(torch.matmul(x.transpose(1, 2), self.W)), self.V)
+        alpha = torch.softmax(e.float() * self.scale, dim=1)  # B, T, 1
+        x = torch.bmm(x, alpha.to(x.dtype)).squeeze(-1)  # B, C
         return x
 
+    @torch.inference_mode()
+    def inference(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x)
+
 
 class encoder(nn.Module):
     """
@@ -59,7 +62,7 @@ class encoder(nn.Module):
         self.time_model = BaseNet()
         self.attention = attention()
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
 
         time = self.time_model(x)
 
@@ -139,23 +142,62 @@ class sleep_model(nn.Module):
             param_k.requires_grad = False  # not update by gradient
 
         self.config = config
+        # position of the centre epoch among the epochs the dataset returns
+        self.centre = config.epoch_len // 2
+        if config.pretext_epochs is not None:
+            self.centre = list(config.pretext_epochs).index(self.centre)
 
     def forward(
             self, weak_data: torch.Tensor,
             strong_data: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
 
-        anchor = self.q_encoder(weak_data[:, (self.config.epoch_len //
-                                              2):(self.config.epoch_len // 2) +
-                                          1, :])
+        anchor = self.q_encoder(weak_data[:, self.centre:self.centre + 1, :])
         anchor = self.q_proj(anchor)
         positive = self.k_encoder(
-            strong_data[:, (self.config.epoch_len //
-                            2):(self.config.epoch_len // 2) + 1, :])
+            strong_data[:, self.centre:self.centre + 1, :])
         positive = self.k_proj(positive)
 
         return anchor, positive
 
 
+class moco_queue(nn.Module):
+    """
+    Class for the dictionary queue of negative keys
+
+    A fixed ring buffer of L2-normalized keys. New keys overwrite the oldest ones at the
+    write pointer, so enqueueing costs O(batch) regardless of the queue size. Keys and
+    pointer are buffers and therefore part of the model state dict.
+
+    Attributes:
+    -----------
+        size: int
+            Number of keys in the queue
+        dim: int
+            Dimension of the keys
+
+    Methods:
+    --------
+        enqueue: torch.Tensor -> None
+            Normalizes the keys and writes them over the oldest entries
+
+    """
+
+    def __init__(self, size: int, dim: int = 128):
+
+        super(moco_queue, self).__init__()
+        self.size = size
+        self.register_buffer("keys", F.normalize(torch.rand(size, dim), p=2, dim=1))
+        self.register_buffer("ptr", torch.zeros((), dtype=torch.long))
+
+    @torch.no_grad()
+    def enqueue(self, keys: torch.Tensor):
+
+        keys = F.normalize(keys.detach().float(), p=2, dim=1)[-self.size:]
+        idx = (self.ptr + torch.arange(keys.shape[0], device=self.keys.device)) % self.size
+        self.keys.index_copy_(0, idx, keys)
+        self.ptr.copy_((self.ptr + keys.shape[0]) % self.size)
+
+
 class contrast_loss(nn.Module):
     """
     Class for the contrast loss
@@ -167,7 +209,8 @@ class contrast_loss(nn.Module):
 
     Methods:
     --------
-        forward: torch.Tensor,torch.Tensor-> torch.Tensor,float
+        forward: torch.Tensor,torch.Tensor-> torch.Tensor,torch.Tensor
+            loss against the queued negatives and the positive keys to enqueue
 
     """
 
@@ -176,14 +219,14 @@ class contrast_loss(nn.Module):
 
         self.config = config
         self.model = sleep_model(config)
+        self.queue = moco_queue(config.queue_size, 128)
         self.T = config.temperature
 
     def loss(self, anchor, positive, queue):
 
-        # L2 normalize
+        # L2 normalize, the queued keys are normalized at enqueue time
         anchor = F.normalize(anchor, p=2, dim=1)
         positive = F.normalize(positive, p=2, dim=1)
-        queue = F.normalize(queue, p=2, dim=1)
 
         # positive logits: Nx1, negative logits: NxK
         l_pos = torch.einsum('nc,nc->n', [anchor, positive]).unsqueeze(-1)
@@ -202,9 +245,9 @@ class contrast_loss(nn.Module):
 
         return loss  # mean
 
-    def forward(self, weak, strong, queue):
+    def forward(self, weak, strong):
         anchor, positive = self.model(weak, strong)
-        l1 = self.loss(anchor, positive, queue)
+        l1 = self.loss(anchor, positive, self.queue.keys)
 
         return l1, positive
 
@@ -0,0 +1,178 @@
+"""INT8 post-training quantization of BaseNet for CPU scoring.
+
+BaseNet is quantized in FX graph mode: BatchNorm is folded into the preceding convolutions,
+conv + bn + relu are fused, activation ranges are calibrated on a sample of TuneDataset
+windows and the model is converted to int8 kernels. The attention pooling and the linear
+head stay in fp32. The command reads the encoder and linear head from <name>_best.pt of
+linear evaluation. It calibrates on one set of subjects and reports on the others how
+well the int8 predictions agree with the fp32 ones (macro-F1 and kappa, and against the
+labels) and benchmarks latency and throughput of both models.
+
+This file can also be imported as a module and contains the following:
+
+    * split_subjects - Splits subjects into disjoint calibration and evaluation records.
+    * calibration_windows - Samples windows and labels of records through TuneDataset.
+    * basenet_attr - Name of the BaseNet attribute of an encoder.
+    * quantize_encoder - Returns an int8 copy of an encoder.
+    * accuracy_report - Compares the predictions of the fp32 and int8 models.
+    * benchmark - Measures latency and throughput of a model.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import argparse
+import copy
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import cohen_kappa_score, f1_score
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from config import Config
+from export import STAGES, load_head, scoring_model
+from models.model import encoder
+from utils.dataloader import TuneDataset, subject_store
+
+
+def split_subjects(subjects: List, calib_fraction: float = 0.25,
+                   seed: int = 1234) -> Tuple[List, List]:
+    """Records of disjoint calibration and evaluation subjects, so the report is held out"""
+    assert len(subjects) > 1, "need at least two subjects to hold out the report"
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(subjects))
+    n_calib = min(max(1, int(round(calib_fraction * len(subjects)))), len(subjects) - 1)
+    calib = [rec for i in order[:n_calib] for rec in subjects[i]]
+    held_out = [rec for i in order[n_calib:] for rec in subjects[i]]
+    return calib, held_out
+
+
+def calibration_windows(records: List, n_windows: int = 2048,
+                        seed: int = 1234) -> Tuple[np.ndarray, np.ndarray]:
+    """(n, 1, 3000) windows and labels sampled uniformly from the records"""
+    dataset = TuneDataset(records)
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(len(dataset), size=min(n_windows, len(dataset)), replace=False)
+    windows, labels = zip(*[dataset[i] for i in np.sort(idx)])
+    return np.stack(windows).astype(np.float32), np.asarray(labels)
+
+
+# The CARE encoders keep BaseNet as model, the SimCLR, SimSiam and MoCo ones as time_model
+BASENET_ATTRS = ("model", "time_model")
+
+
+def basenet_attr(eeg_encoder: nn.Module) -> str:
+    for attr in BASENET_ATTRS:
+        if isinstance(getattr(eeg_encoder, attr, None), nn.Module):
+            return attr
+    raise AttributeError(f"{type(eeg_encoder).__name__} has none of {BASENET_ATTRS}")
+
+
+@torch.no_grad()
+def quantize_encoder(eeg_encoder: nn.Module, windows: np.ndarray, batch_size: int = 256,
+                     backend: Optional[str] = None) -> nn.Module:
+    """int8 copy of eeg_encoder with BaseNet quantized and calibrated on windows"""
+    engines = torch.backends.quantized.supported_engines
+    backend = backend or ("x86" if "x86" in engines else "fbgemm")
+    torch.backends.quantized.engine = backend
+
+    quantized = copy.deepcopy(eeg_encoder).eval()
+    attr = basenet_attr(quantized)
+    example = torch.from_numpy(windows[:1])
+    # prepare_fx folds BatchNorm and fuses conv + bn + relu before inserting observers
+    prepared = prepare_fx(getattr(quantized, attr), get_default_qconfig_mapping(backend), (example,))
+    for start in range(0, windows.shape[0], batch_size):
+        prepared(torch.from_numpy(windows[start:start + batch_size]))
+    setattr(quantized, attr, convert_fx(prepared))
+    return quantized
+
+
+@torch.no_grad()
+def predict(model: nn.Module, windows: np.ndarray, batch_size: int = 256) -> np.ndarray:
+    preds = []
+    for start in range(0, windows.shape[0], batch_size):
+        logits = model(torch.from_numpy(windows[start:start + batch_size]))
+        preds.append(logits.argmax(dim=-1).numpy())
+    return np.concatenate(preds)
+
+
+def accuracy_report(fp32_model: nn.Module, int8_model: nn.Module, windows: np.ndarray,
+                    labels: Optional[np.ndarray] = None) -> Dict[str, float]:
+    fp32_preds = predict(fp32_model, windows)
+    int8_preds = predict(int8_model, windows)
+    report = {
+        "agreement": float((fp32_preds == int8_preds).mean()),
+        "f1_vs_fp32": f1_score(fp32_preds, int8_preds, average="macro"),
+        "kappa_vs_fp32": cohen_kappa_score(fp32_preds, int8_preds),
+    }
+    if labels is not None:
+        for name, preds in (("fp32", fp32_preds), ("int8", int8_preds)):
+            report[f"f1_{name}"] = f1_score(labels, preds, average="macro")
+            report[f"kappa_{name}"] = cohen_kappa_score(labels, preds)
+    return report
+
+
+@torch.no_grad()
+def benchmark(model: nn.Module, batch_size: int = 256, n_iters: int = 10,
+              num_threads: Optional[int] = None) -> Dict[str, float]:
+    """Mean latency per batch in ms and throughput in epochs per second"""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    x = torch.randn(batch_size, 1, 3000)
+    model(x)  # warm up
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        model(x)
+    elapsed = (time.perf_counter() - start) / n_iters
+    return {"latency_ms": elapsed * 1e3, "epochs_per_s": batch_size / elapsed}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization of BaseNet")
+    parser.add_argument("--chkpoint", type=str, required=True,
+                        help="<name>_best.pt of a pretraining run, with the encoder and linear head")
+    parser.add_argument("--head", type=str, default=None,
+                        help="Checkpoint with lin_state_dict, if not in --chkpoint")
+    parser.add_argument("--data_dir", type=str, default="/scratch/sleepkfold_allsamples/test",
+                        help="Directory of npz records for calibration and the report")
+    parser.add_argument("--calib_fraction", type=float, default=0.25,
+                        help="Fraction of subjects used for calibration, the rest for the report")
+    parser.add_argument("--n_calib", type=int, default=2048)
+    parser.add_argument("--n_eval", type=int, default=8192)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=1, help="Benchmark threads")
+    parser.add_argument("--out", type=str, default="./scoring_model_int8.pt")
+    args = parser.parse_args()
+
+    chkpoint = torch.load(args.chkpoint, map_location="cpu")
+    head_chkpoint = chkpoint if args.head is None else torch.load(args.head, map_location="cpu")
+    eeg_encoder = encoder(Config())
+    eeg_encoder.load_state_dict(chkpoint["eeg_model_state_dict"])
+    lin = nn.Linear(256, len(STAGES))
+    lin.load_state_dict(load_head(head_chkpoint))
+    fp32_model = scoring_model(eeg_encoder, lin).eval()
+
+    files = sorted(os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir))
+    calib_records, eval_records = split_subjects(subject_store(files).subjects,
+                                                 args.calib_fraction)
+    calib, _ = calibration_windows(calib_records, args.n_calib, seed=0)
+    windows, labels = calibration_windows(eval_records, args.n_eval, seed=1)
+
+    int8_model = scoring_model(quantize_encoder(eeg_encoder, calib, args.batch_size),
+                               copy.deepcopy(lin)).eval()
+
+    for key, value in accuracy_report(fp32_model, int8_model, windows, labels).items():
+        print(f"{key}: {value:.4f}")
+    for name, model in (("fp32", fp32_model), ("int8", int8_model)):
+        stats = benchmark(model, args.batch_size, num_threads=args.threads)
+        print(f"{name}: {stats['latency_ms']:.1f} ms/batch, {stats['epochs_per_s']:.0f} epochs/s")
+
+    scripted = torch.jit.freeze(torch.jit.script(int8_model))
+    torch.jit.save(scripted, args.out)
+    print(f"Saved {args.out}")
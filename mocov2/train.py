@@ -3,7 +3,8 @@ import numpy as np
 import torch
 import argparse
 import os
-from utils.dataloader import pretext_data
+import time
+from utils.dataloader import pretext_data, subject_store
 from helper_train import sleep_pretrain
 from torch.utils.data import DataLoader
 from config import Config
@@ -30,6 +31,10 @@ parser.add_argument("--save_path",
                     type=str,
                     default="./saved_weights",
                     help="Path to save weights")
+parser.add_argument("--run_id",
+                    type=str,
+                    default=time.strftime("%Y%m%d-%H%M%S"),
+                    help="Run tag eval_worker.py waits on with config.async_eval")
 
 args = parser.parse_args()
 
@@ -42,6 +47,7 @@ ss_wandb = wandb.init(
     entity="sleep-staging",
 )
 config = Config(ss_wandb)
+config.run_id = args.run_id
 
 config.src_path = args.data_dir
 config.exp_path = os.path.join(args.save_path, name)
@@ -51,41 +57,32 @@ if not os.path.exists(config.exp_path):
 
 config.le_path = "/scratch/sleepkfold_allsamples/test"
 
+if config.async_eval:
+    print(f"Run id: {config.run_id}")
+
 ss_wandb.save("./config.py")
 ss_wandb.save("./trainer.py")
 ss_wandb.save("./data_preprocessing/*")
 ss_wandb.save("./models/*")
 
-PRETEXT_FILE = os.listdir(os.path.join(config.src_path, "pretext"))
-PRETEXT_FILE.sort(key=natural_keys)
-PRETEXT_FILE = [
-    os.path.join(config.src_path, "pretext", f) for f in PRETEXT_FILE
-]
+PRETEXT_PATH = os.path.join(config.src_path, "pretext")
+pretext_dataset = pretext_data(config, PRETEXT_PATH)
 
 TEST_FILE = os.listdir(os.path.join(config.le_path))
 TEST_FILE.sort(key=natural_keys)
 TEST_FILE = [os.path.join(config.le_path, f) for f in TEST_FILE]
 
-print(f"Number of pretext files: {len(PRETEXT_FILE)}")
+print(f"Number of pretext windows: {len(pretext_dataset)}")
 print(f"Number of test records: {len(TEST_FILE)}")
 
 pretext_loader = DataLoader(
-    pretext_data(config, PRETEXT_FILE),
+    pretext_dataset,
     batch_size=config.batch_size,
     shuffle=True,
     num_workers=10,
 )
 
-test_records = [np.load(f) for f in TEST_FILE]
-test_subjects = dict()
-
-for i, rec in enumerate(test_records):
-    if rec["_description"][0] not in test_subjects.keys():
-        test_subjects[rec["_description"][0]] = [rec]
-    else:
-        test_subjects[rec["_description"][0]].append(rec)
-
-test_subjects = list(test_subjects.values())
+test_subjects = subject_store(TEST_FILE, config.subject_cache_path)
 
 model = sleep_pretrain(config, name, pretext_loader, test_subjects, ss_wandb)
 ss_wandb.watch([model], log="all", log_freq=500)
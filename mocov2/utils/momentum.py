@@ -0,0 +1,102 @@
+"""Momentum (EMA) update of the target networks.
+
+The target branches follow their online branches as an exponential moving average. The
+parameters of all branches are gathered into flat lists once, so every training step
+updates all of them in place with a single multi-tensor call instead of allocating a new
+tensor per parameter.
+
+This file can also be imported as a module and contains the following:
+
+    * momentum_updater - Updates target networks as a moving average of online networks.
+"""
+
+import math
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+
+class momentum_updater(object):
+    """
+    Class for the momentum update of target networks
+
+    Attributes:
+    -----------
+        pairs: list of (nn.Module, nn.Module)
+            (online, target) module pairs with identically ordered parameters
+        m: float, optional
+            momentum at the first step
+        m_end: float, optional
+            momentum reached after total_steps along a cosine schedule, m is kept
+            constant if None
+        total_steps: int, optional
+            length of the momentum schedule in steps
+        update_buffers: bool, optional
+            also average the floating point buffers (BatchNorm running statistics) and
+            copy the integer ones (num_batches_tracked)
+
+    Methods:
+    --------
+        momentum: -> float
+            momentum of the current step
+        step: -> float
+            updates every target network in place and returns the momentum used
+
+    """
+
+    def __init__(
+        self,
+        pairs: List[Tuple[nn.Module, nn.Module]],
+        m: float = 0.9995,
+        m_end: Optional[float] = None,
+        total_steps: Optional[int] = None,
+        update_buffers: bool = False,
+    ):
+        self.m = m
+        self.m_end = m if m_end is None else m_end
+        self.total_steps = total_steps
+        self.step_count = 0
+
+        self.online, self.target = [], []
+        self.online_buffers, self.target_buffers = [], []
+        self.online_counters, self.target_counters = [], []
+
+        for online, target in pairs:
+            online_params = list(online.parameters())
+            target_params = list(target.parameters())
+            assert len(online_params) == len(target_params), "networks do not match"
+            self.online.extend(online_params)
+            self.target.extend(target_params)
+
+            if update_buffers:
+                for buf_q, buf_k in zip(online.buffers(), target.buffers()):
+                    if buf_q.is_floating_point():
+                        self.online_buffers.append(buf_q)
+                        self.target_buffers.append(buf_k)
+                    else:
+                        self.online_counters.append(buf_q)
+                        self.target_counters.append(buf_k)
+
+    def momentum(self) -> float:
+        if self.total_steps is None or self.m_end == self.m:
+            return self.m
+        progress = min(self.step_count / self.total_steps, 1.0)
+        return self.m_end - (self.m_end - self.m) * (math.cos(math.pi * progress) + 1) / 2
+
+    @torch.no_grad()
+    def step(self) -> float:
+        m = self.momentum()
+
+        # param_k = param_k * m + param_q * (1 - m)
+        torch._foreach_mul_(self.target, m)
+        torch._foreach_add_(self.target, self.online, alpha=1.0 - m)
+
+        if self.target_buffers:
+            torch._foreach_mul_(self.target_buffers, m)
+            torch._foreach_add_(self.target_buffers, self.online_buffers, alpha=1.0 - m)
+        for buf_q, buf_k in zip(self.online_counters, self.target_counters):
+            buf_k.copy_(buf_q)
+
+        self.step_count += 1
+        return m
@@ -1,9 +1,10 @@
-import os, shutil
-import torch
+import os
 import numpy as np
 import argparse
+import multiprocessing as mp
 
-from torch.nn.functional import interpolate
+from scipy.signal import resample_poly
+from tqdm import tqdm
 
 seed = 123
 np.random.seed(seed)
@@ -13,72 +14,117 @@ parser = argparse.ArgumentParser()
 
 parser.add_argument("--dir", type=str, default="/scratch/shhs_outputs",
                     help="File path to the PSG and annotation files.")
-
-args = parser.parse_args()
+parser.add_argument("--out_dir", type=str, default="/scratch/new_shhs_9",
+                    help="Directory the pretext and test files are written to.")
+parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"],
+                    help="Storage dtype of the packed pretext shards.")
+parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="Recordings processed in parallel.")
 
 ## ARGS
 half_window = 4
-dire = '/scratch/new_shhs_9'
 ##
 
-data_dir = os.path.join(dire, "shhs_outputs")    
-if not os.path.exists(dire):
-    os.makedirs(dire, exist_ok=True)
-    
-shutil.copytree(args.dir, data_dir)
 
-files = os.listdir(data_dir)
-files = np.array([os.path.join(data_dir, i) for i in files])
-files.sort()
+def load_recording(file):
+    """First EEG channel of a converted recording as (n_epochs, 1, 3000) epochs at 100 Hz.
 
+    The recording is resampled from 125 Hz once, as one continuous signal, with an
+    anti-aliased polyphase filter (4/5), so epoch borders are filtered like any other
+    sample. Recordings that are not 1 or 2 channel outputs of shhs.py return None.
+    """
+    dat = np.load(file)
+    x = dat["x"]
+    if x.shape[-1] not in (1, 2):
+        return None, None
+    n_epochs = x.shape[0]
+    signal = x[:, :, 0].reshape(-1).astype(np.float64) * 1000
+    signal = resample_poly(signal, 4, 5)
+    return signal.reshape(n_epochs, 1, -1).astype(np.float32), dat["y"]
+
+
+def write_shard(job):
+    # Every pretext recording is written once as a contiguous (n_epochs, 1, 3000) shard.
+    file, pretext_dir, dtype = job
+    x_dat, _ = load_recording(file)
+    if x_dat is None or x_dat.shape[0] < 2*half_window+1:
+        return None, 0
+    shard = os.path.basename(file).replace(".npz", ".npy")
+    np.save(os.path.join(pretext_dir, shard), x_dat.astype(dtype))
+    return shard, x_dat.shape[0]
+
+
+def write_test(job):
+    file, test_dir = job
+    windows, y = load_recording(file)
+    if windows is None:
+        return False
+    new_dat = dict()
+    new_dat['_description'] = [file]
+    new_dat['windows'] = windows
+    new_dat['y'] = y.astype('int')
 
-######## pretext files##########
+    # Written under a name without .npz, so an interrupted write is never read as a record
+    temp_path = os.path.join(test_dir, os.path.basename(file))
+    with open(temp_path + ".tmp", "wb") as f:
+        np.savez(f, **new_dat)
+    os.replace(temp_path + ".tmp", temp_path)
+    return True
 
-pretext_files = list(np.random.choice(files,264,replace=False))    #change
 
-print("pretext files: ", len(pretext_files))
-from tqdm import tqdm
+if __name__ == "__main__":
 
+    args = parser.parse_args()
+    dire = args.out_dir
 
-# load files
-os.makedirs(dire+"/pretext/",exist_ok=True)
+    # The converted recordings are read in place, partial writes of shhs.py end in .tmp
+    files = os.listdir(args.dir)
+    files = np.array([os.path.join(args.dir, i) for i in files if i.endswith(".npz")])
+    files.sort()
 
-cnt = 0
-for file in tqdm(pretext_files):
-    x_dat = np.load(file)["x"]*1000
-    if x_dat.shape[-1]==2:
-        #mean = np.mean(x_dat.reshape(-1,2),axis=0).reshape(1,1,2)
-        #std = np.std(x_dat.reshape(-1,2),axis=0).reshape(1,1,2)
-        #x_dat = (x_dat-mean)/std
-        x_dat = x_dat.transpose(0,2,1)
-        x_dat = np.expand_dims(x_dat[:,0,:],1)
 
-        for i in range(half_window,x_dat.shape[0]-half_window):
-            dct = {}
-            temp_path = os.path.join(dire+"/pretext/",str(cnt)+".npz")
-            dct['pos'] = interpolate(torch.tensor(x_dat[i-half_window:i+half_window+1]),scale_factor=3000/3750).numpy()
-            #dct['pos'] = x_dat[i-half_window:i+half_window+1]
-            np.savez(temp_path,**dct)
-            cnt+=1
+    ######## pretext files##########
 
+    pretext_files = list(np.random.choice(files,264,replace=False))    #change
 
-######## test files##########
-test_files = sorted(list(set(files)-set(pretext_files))) 
-os.makedirs(dire+"/test/",exist_ok=True)
+    print("pretext files: ", len(pretext_files))
 
-print("test files: ", len(test_files))
 
-for file in tqdm(test_files):
-    new_dat = dict()
-    dat = np.load(file)
+    # load files
+    # index.npz lists the shard and centre epoch of every window, the windows themselves
+    # are sliced out of the memory-mapped shards by pretext_data at load time.
+    pretext_dir = os.path.join(dire, "pretext")
+    test_dir = os.path.join(dire, "test")
+    os.makedirs(pretext_dir, exist_ok=True)
+    os.makedirs(test_dir, exist_ok=True)
+
+    with mp.Pool(args.workers) as pool:
+        shards, shard_ids, centres = [], [], []
+        jobs = [(file, pretext_dir, args.dtype) for file in pretext_files]
+        for shard, n_epochs in tqdm(pool.imap(write_shard, jobs), total=len(jobs)):
+            if shard is None:
+                continue
+            centre = np.arange(half_window, n_epochs-half_window)
+            shard_ids.append(np.full(len(centre), len(shards)))
+            centres.append(centre)
+            shards.append(shard)
+
+        # No recording may be long enough for a window, the index is then empty
+        np.savez(
+            os.path.join(pretext_dir, "index.npz"),
+            shards=np.array(shards, dtype=str),
+            shard_ids=np.concatenate(shard_ids) if shard_ids else np.zeros(0, dtype=int),
+            centres=np.concatenate(centres) if centres else np.zeros(0, dtype=int),
+            half_window=half_window,
+        )
+        print("pretext windows: ", sum(len(c) for c in centres))
+
+
+        ######## test files##########
+        test_files = sorted(list(set(files)-set(pretext_files)))
 
-    if dat['x'].shape[-1]==2:
-        
-        new_dat['_description'] = [file]
-        new_dat['windows'] = interpolate(torch.tensor(dat['x'].transpose(0,2,1)),scale_factor=3000/3750).numpy()*1000
-        new_dat['windows'] = np.expand_dims(new_dat['windows'][:,0,:],1)
+        print("test files: ", len(test_files))
 
-        new_dat['y'] = dat['y'].astype('int')
-        
-        temp_path = os.path.join(dire+"/test/",os.path.basename(file))
-        np.savez(temp_path,**new_dat)
+        jobs = [(file, test_dir) for file in test_files]
+        written = sum(tqdm(pool.imap_unordered(write_test, jobs), total=len(jobs)))
+        print("test files written: ", written)
@@ -17,6 +17,9 @@ import numpy as np
 
 import argparse
 import glob
+import json
+import time
+import multiprocessing as mp
 import math
 import ntpath
 
@@ -40,16 +43,19 @@ import xml.etree.ElementTree as ET
 EVENT_CHANNEL = 'EDF Annotations'
 # log = logging.getLogger(__name__)
 
-class EDFEndOfData(Exception): pass
+# physical units of EDF signals in volts, as MNE reports them
+UNIT_SCALE = {'V': 1., 'mV': 1e-3, 'uV': 1e-6, 'µV': 1e-6, 'nV': 1e-9}
 
 def tal(tal_str):
     '''Return a list with (onset, duration, annotation) tuples for an EDF+ TAL
   stream.
   '''
+    if isinstance(tal_str, bytes):
+        tal_str = tal_str.decode('utf-8', errors='replace')
     exp = '(?P<onset>[+\-]\d+(?:\.\d*)?)' + '(?:\x15(?P<duration>\d+(?:\.\d*)?))?' + '(\x14(?P<annotation>[^\x00]*))?' + '(?:\x14\x00)'
 
     def annotation_to_list(annotation):
-        return str(annotation.encode('utf-8')).split('\x14') if annotation else []
+        return [a for a in annotation.split('\x14') if a] if annotation else []
 
     def parse(dic):
         return (
@@ -63,51 +69,81 @@ def tal(tal_str):
 def edf_header(f):
     h = {}
     assert f.tell() == 0  # check file position
-    assert f.read(8) == '0       '
+    read = lambda n: f.read(n).decode('latin-1')
+    assert read(8) == '0       ', 'not an EDF file'
 
     # recording info)
-    h['local_subject_id'] = f.read(80).strip()
-    h['local_recording_id'] = f.read(80).strip()
+    h['local_subject_id'] = read(80).strip()
+    h['local_recording_id'] = read(80).strip()
 
     # parse timestamp
-    (day, month, year) = [int(x) for x in re.findall('(\d+)', f.read(8))]
-    (hour, minute, sec)= [int(x) for x in re.findall('(\d+)', f.read(8))]
-    h['date_time'] = str(datetime.datetime(year + 2000, month, day,
-    hour, minute, sec))
+    (day, month, year) = [int(x) for x in re.findall('(\d+)', read(8))]
+    (hour, minute, sec)= [int(x) for x in re.findall('(\d+)', read(8))]
+    year = year + 2000 if year < 85 else year + 1900
+    h['date_time'] = str(datetime(year, month, day, hour, minute, sec))
 
     # misc
-    header_nbytes = int(f.read(8))
-    subtype = f.read(44)[:5]
+    h['header_nbytes'] = int(read(8))
+    subtype = read(44)[:5]
     h['EDF+'] = subtype in ['EDF+C', 'EDF+D']
     h['contiguous'] = subtype != 'EDF+D'
-    h['n_records'] = int(f.read(8))
-    h['record_length'] = float(f.read(8))  # in seconds
-    nchannels = h['n_channels'] = int(f.read(4))
+    h['n_records'] = int(read(8))
+    h['record_length'] = float(read(8))  # in seconds
+    nchannels = h['n_channels'] = int(read(4))
 
     # read channel info
     channels = range(h['n_channels'])
-    h['label'] = [f.read(16).strip() for n in channels]
-    h['transducer_type'] = [f.read(80).strip() for n in channels]
-    h['units'] = [f.read(8).strip() for n in channels]
-    h['physical_min'] = np.asarray([float(f.read(8)) for n in channels])
-    h['physical_max'] = np.asarray([float(f.read(8)) for n in channels])
-    h['digital_min'] = np.asarray([float(f.read(8)) for n in channels])
-    h['digital_max'] = np.asarray([float(f.read(8)) for n in channels])
-    h['prefiltering'] = [f.read(80).strip() for n in channels]
-    h['n_samples_per_record'] = [int(f.read(8)) for n in channels]
+    h['label'] = [read(16).strip() for n in channels]
+    h['transducer_type'] = [read(80).strip() for n in channels]
+    h['units'] = [read(8).strip() for n in channels]
+    h['physical_min'] = np.asarray([float(read(8)) for n in channels])
+    h['physical_max'] = np.asarray([float(read(8)) for n in channels])
+    h['digital_min'] = np.asarray([float(read(8)) for n in channels])
+    h['digital_max'] = np.asarray([float(read(8)) for n in channels])
+    h['prefiltering'] = [read(80).strip() for n in channels]
+    h['n_samples_per_record'] = [int(read(8)) for n in channels]
     f.read(32 * nchannels)  # reserved
 
-    #assert f.tell() == header_nbytes
+    assert f.tell() == h['header_nbytes']
     return h
 
 
-class BaseEDFReader:
-    def __init__(self, file):
-        self.file = file
-
-
-    def read_header(self):
-        self.header = h = edf_header(self.file)
+class edf_reader(object):
+    """
+    Class for reading EDF/EDF+ files through a memory map
+
+    The header is parsed once and the data records are mapped as a (n_records,
+    samples_per_record) int16 array. Every channel is a strided view of its columns,
+    so only the pages of the requested channels are read from disk. They are decoded
+    in large blocks of records with the gain and offset applied in bulk.
+
+    Attributes:
+    -----------
+        path: str
+            EDF/EDF+ file
+        block_records: int, optional
+            data records decoded per vectorized block
+
+    Methods:
+    --------
+        channel_index: str -> int
+            index of a channel label
+        sample_rate: int or str -> float
+            sampling rate of a channel
+        raw: int or str -> np.ndarray
+            (n_records, n_samples_per_record) int16 view of a channel
+        signals: list of int or str -> np.ndarray
+            (n_channels, n_samples) physical values of channels with the same rate
+        annotations: -> list of (float, float, list)
+            record onsets and EDF+ annotations
+
+    """
+
+    def __init__(self, path, block_records=4096):
+        self.path = path
+        self.block_records = block_records
+        with open(path, 'rb') as f:
+            self.header = h = edf_header(f)
 
         # calculate ranges for rescaling
         self.dig_min = h['digital_min']
@@ -117,70 +153,79 @@ class BaseEDFReader:
         assert np.all(phys_range > 0)
         assert np.all(dig_range > 0)
         self.gain = phys_range / dig_range
-
-
-    def read_raw_record(self):
-        '''Read a record with data_2013 and return a list containing arrays with raw
-        bytes.
-        '''
-        result = []
-        for nsamp in self.header['n_samples_per_record']:
-            samples = self.file.read(nsamp * 2)
-            if len(samples) != nsamp * 2:
-                raise EDFEndOfData
-            result.append(samples)
-        return result
-
-
-    def convert_record(self, raw_record):
-        '''Convert a raw record to a (time, signals, events) tuple based on
-        information in the header.
-        '''
-        h = self.header
-        dig_min, phys_min, gain = self.dig_min, self.phys_min, self.gain
-        time = float('nan')
-        signals = []
-        events = []
-        for (i, samples) in enumerate(raw_record):
-            if h['label'][i] == EVENT_CHANNEL:
-                ann = tal(samples)
-                time = ann[0][0]
-                events.extend(ann[1:])
-                # print(i, samples)
-                # exit()
-            else:
-                # 2-byte little-endian integers
-                dig = np.fromstring(samples, '<i2').astype(np.float32)
-                phys = (dig - dig_min[i]) * gain[i] + phys_min[i]
-                signals.append(phys)
-
-        return time, signals, events
-
-
-    def read_record(self):
-        return self.convert_record(self.read_raw_record())
-
-
-    def records(self):
-        '''
-        Record generator.
-        '''
-        try:
-            while True:
-                yield self.read_record()
-        except EDFEndOfData:
-            pass
+        self.offset = self.phys_min - self.dig_min * self.gain
+
+        # 2-byte little-endian integers, records of all channels one after another
+        n_samples = np.asarray(h['n_samples_per_record'])
+        self.starts = np.concatenate([[0], np.cumsum(n_samples)[:-1]])
+        record_samples = int(n_samples.sum())
+        n_records = (os.path.getsize(path) - h['header_nbytes']) // (2 * record_samples)
+        if h['n_records'] > 0:
+            n_records = min(n_records, h['n_records'])
+        self.n_records = n_records
+        self.records = np.memmap(path, dtype='<i2', mode='r', offset=h['header_nbytes'],
+                                 shape=(n_records, record_samples))
+
+    @property
+    def labels(self):
+        return self.header['label']
+
+    def channel_index(self, channel):
+        return channel if isinstance(channel, (int, np.integer)) else self.labels.index(channel)
+
+    def sample_rate(self, channel):
+        i = self.channel_index(channel)
+        return self.header['n_samples_per_record'][i] / self.header['record_length']
+
+    def raw(self, channel):
+        i = self.channel_index(channel)
+        return self.records[:, self.starts[i]:self.starts[i] + self.header['n_samples_per_record'][i]]
+
+    def signals(self, channels, unit_scale=False, dtype=np.float32):
+        '''Physical values of channels, in volts if unit_scale (as MNE returns them)'''
+        idx = [self.channel_index(c) for c in channels]
+        n_samples = {self.header['n_samples_per_record'][i] for i in idx}
+        assert len(n_samples) == 1, 'Multiple sample rates not supported!'
+        n_samples = n_samples.pop()
+
+        gain, offset = self.gain[idx], self.offset[idx]
+        if unit_scale:
+            scale = np.array([UNIT_SCALE.get(self.header['units'][i], 1.) for i in idx])
+            gain, offset = gain * scale, offset * scale
+        gain = gain.astype(dtype)[:, None, None]
+        offset = offset.astype(dtype)[:, None, None]
+
+        out = np.empty((len(idx), self.n_records, n_samples), dtype=dtype)
+        views = [self.raw(i) for i in idx]
+        for start in range(0, self.n_records, self.block_records):
+            stop = min(start + self.block_records, self.n_records)
+            block = np.stack([v[start:stop] for v in views])
+            np.multiply(block, gain, out=out[:, start:stop])
+            out[:, start:stop] += offset
+        return out.reshape(len(idx), -1)
+
+    def annotations(self):
+        '''Onset of every record and the EDF+ annotations of the file'''
+        if EVENT_CHANNEL not in self.labels:
+            return np.arange(self.n_records) * self.header['record_length'], []
+        raw = self.raw(EVENT_CHANNEL)
+        rectime, events = [], []
+        for r in range(self.n_records):
+            ann = tal(raw[r].tobytes())
+            rectime.append(ann[0][0])
+            events.extend(ann[1:])
+        return np.asarray(rectime), events
 
 
 def load_edf(edffile):
     '''Load an EDF+ file.
-  Very basic reader for EDF and EDF+ files. While BaseEDFReader does support
-  exotic features like non-homogeneous sample rates and loading only parts of
-  the stream, load_edf expects a single fixed sample rate for all channels and
+  Very basic reader for EDF and EDF+ files. While edf_reader does support
+  exotic features like non-homogeneous sample rates and loading only some
+  channels, load_edf expects a single fixed sample rate for all channels and
   tries to load the whole file.
   Parameters
   ----------
-  edffile : file-like object or string
+  edffile : string
   Returns
   -------
   Named tuple with the fields:
@@ -202,34 +247,20 @@ def load_edf(edffile):
       description : list with strings
         Contains (multiple?) descriptions of the annotation event.
   '''
-    if isinstance(edffile, basestring):
-        with open(edffile, 'rb') as f:
-            return load_edf(f)  # convert filename to file
-
-    reader = BaseEDFReader(edffile)
-    reader.read_header()
-
+    reader = edf_reader(edffile)
     h = reader.header
-    log.debug('EDF header: %s' % h)
 
-      # get sample rate info
-    nsamp = np.unique(
-        [n for (l, n) in zip(h['label'], h['n_samples_per_record'])
-        if l != EVENT_CHANNEL])
-    assert nsamp.size == 1, 'Multiple sample rates not supported!'
-    sample_rate = float(nsamp[0]) / h['record_length']
-
-    rectime, X, annotations = zip(*reader.records())
-    X = np.hstack(X)
-    annotations = reduce(operator.add, annotations)
-    chan_lab = [lab for lab in reader.header['label'] if lab != EVENT_CHANNEL]
+    chan_lab = [lab for lab in h['label'] if lab != EVENT_CHANNEL]
+    sample_rate = reader.sample_rate(chan_lab[0])
+    X = reader.signals(chan_lab)
+    rectime, annotations = reader.annotations()
 
       # create timestamps
-    if reader.header['contiguous']:
+    if h['contiguous']:
         time = np.arange(X.shape[1]) / sample_rate
     else:
-        reclen = reader.header['record_length']
-        within_rec_time = np.linspace(0, reclen, nsamp, endpoint=False)
+        nsamp = int(sample_rate * h['record_length'])
+        within_rec_time = np.linspace(0, h['record_length'], nsamp, endpoint=False)
         time = np.hstack([t + within_rec_time for t in rectime])
 
     tup = namedtuple('EDF', 'X sample_rate chan_lab time annotations')
@@ -240,107 +271,158 @@ def load_edf(edffile):
 
 
 EPOCH_SEC_SIZE = 30
+MANIFEST = "manifest.jsonl"
 
 # data on GNODE 25 DATE: 06-12-21 (ALL 329 files of SHHS1)
 
 
-data_dir = '/scratch/SLEEP_data/shhs/polysomnography/edfs/shhs1'
-ann_dir = '/scratch/SLEEP_data/shhs/polysomnography/annotations-events-profusion/shhs1'
-output_dir = '/scratch/SLEEP_data/shhs/output'
-select_ch = 'EEG C4-A1'  #EEG (sec)	C3	A2  #EEG	C4	A1
-
-csv_path = '/scratch/SLEEP_data/selected_shhs1_files.txt'
-if not os.path.exists(output_dir):
-    os.mkdir(output_dir)
-
-#ids = pd.read_csv("selected_shhs1_files.txt", header=None, names='a')
-ids = pd.read_csv(csv_path, header=None)
-ids = ids[0].values.tolist()
-
-edf_fnames = [os.path.join(data_dir, i + ".edf") for i in ids]
-ann_fnames = [os.path.join(ann_dir,  i + "-profusion.xml") for i in ids]
-
-edf_fnames.sort()
-ann_fnames.sort()
-
-edf_fnames = np.asarray(edf_fnames)
-ann_fnames = np.asarray(ann_fnames)
-
-#yahase 
-for file_id in range(len(edf_fnames)):
-    if os.path.exists(os.path.join(output_dir, edf_fnames[file_id].split('/')[-1])[:-4]+".npz"):
-        continue
-    print(edf_fnames[file_id])
-    select_ch = 'EEG C4-A1'
-    raw = read_raw_edf(edf_fnames[file_id], preload=True, stim_channel=None, verbose=None)
-    sampling_rate = raw.info['sfreq']
-    ch_type = select_ch.split(" ")[0]    # selecting EEG out of 'EEG C4-A1'
-    select_ch = sorted([s for s in raw.info["ch_names"] if ch_type in s]) # this has 2 vals [EEG,EEG(sec)] and selecting 0th index
-    print(select_ch)
-    raw_ch_df = raw.to_data_frame(scalings=sampling_rate)[select_ch]
-    print(raw_ch_df.shape)
-    #raw_ch_df = raw_ch_df.to_frame()
-    raw_ch_df.set_index(np.arange(len(raw_ch_df)))
-  
-    labels = []
-    # Read annotation and its header
-    t = ET.parse(ann_fnames[file_id])
-    r = t.getroot()
-    faulty_File = 0
-    for i in range(len(r[4])):
-        lbl = int(r[4][i].text)
-        if lbl == 4:  # make stages N3, N4 same as N3
-            labels.append(3)
-        elif lbl == 5:  # Assign label 4 for REM stage
-            labels.append(4)
+def read_labels(ann_fname):
+    '''Sleep stages of an SHHS profusion annotation file.
+    N3 and N4 are merged into 3 and REM becomes 4. faulty is True if the file has
+    labels > 5 (movement / unscored), such files are not converted.
+    '''
+    r = ET.parse(ann_fname).getroot()
+    stages = np.array([int(s.text) for s in r[4]], dtype=np.int32)
+    faulty = bool(np.any(stages > 5))
+    labels = stages.copy()
+    labels[stages == 4] = 3  # make stages N3, N4 same as N3
+    labels[stages == 5] = 4  # Assign label 4 for REM stage
+    return labels, faulty
+
+
+def convert_recording(job):
+    '''Converts one recording and returns its manifest entry.
+
+    Only the selected EEG channels are read from the EDF, through edf_reader or MNE.
+    The signals are in volts scaled by the sampling rate, as
+    raw.to_data_frame(scalings=sampling_rate) returned them, cut into 30-s epochs
+    with a reshape, trimmed to the sleep period +- 30 min and written to
+    <output_dir>/<id>.npz through a temporary file, so a killed run never leaves a
+    partial output behind.
+    '''
+    edf_fname, ann_fname, output_dir, ch_type, n_channels, reader = job
+    filename = os.path.basename(edf_fname).replace(".edf", ".npz")
+    entry = {"file": filename, "status": "done", "seconds": 0.0, "error": None}
+    start = time.time()
+    try:
+        labels, faulty = read_labels(ann_fname)
+        if faulty:
+            entry["status"] = "faulty"
+            return entry
+
+        if reader == "mne":
+            raw = read_raw_edf(edf_fname, preload=False, stim_channel=None, verbose=False)
+            sampling_rate = raw.info['sfreq']
+            # [EEG, EEG(sec)] -> EEG (C4-A1) first
+            select_ch = sorted([s for s in raw.info["ch_names"] if ch_type in s])[:n_channels]
+            raw_ch = raw.get_data(picks=select_ch).T * sampling_rate
         else:
-            labels.append(lbl)
-        if lbl > 5:  # some files may contain labels > 5 BUT not the selected ones.
-            faulty_File = 1
-
-    if faulty_File == 1:
-        print( "============================== Faulty file ==================")
-        continue
-
-    labels = np.asarray(labels)
-
-    # Remove movement and unknown stages if any
-    raw_ch = raw_ch_df.values
-    print(raw_ch.shape)
-
-    # Verify that we can split into 30-s epochs
-    if len(raw_ch) % (EPOCH_SEC_SIZE * sampling_rate) != 0:
-        raise Exception("Something wrong")
-    n_epochs = len(raw_ch) / (EPOCH_SEC_SIZE * sampling_rate)
-
-    # Get epochs and their corresponding labels
-    x = np.asarray(np.split(raw_ch, n_epochs)).astype(np.float32)
-    y = labels.astype(np.int32)
-
-    print(x.shape)
-    print(y.shape)
-    assert len(x) == len(y)
-
-    # Select on sleep periods
-    w_edge_mins = 30
-    nw_idx = np.where(y != 0)[0]
-    start_idx = nw_idx[0] - (w_edge_mins * 2)
-    end_idx = nw_idx[-1] + (w_edge_mins * 2)
-    if start_idx < 0: start_idx = 0
-    if end_idx >= len(y): end_idx = len(y) - 1
-    select_idx = np.arange(start_idx, end_idx + 1)
-    print("Data before selection: {}, {}".format(x.shape, y.shape))
-    x = x[select_idx]
-    y = y[select_idx]
-    print("Data after selection: {}, {}".format(x.shape, y.shape))
-
-    # Saving as numpy files
-    filename = os.path.basename(edf_fnames[file_id]).replace(".edf",  ".npz")
-    save_dict = {
-        "x": x,
-        "y": y,
-        "fs": sampling_rate
-    }
-    np.savez(os.path.join(output_dir, filename), **save_dict)
-    print(" ---------- Done this file ---------")
+            edf = edf_reader(edf_fname)
+            select_ch = sorted([s for s in edf.labels if ch_type in s])[:n_channels]
+            sampling_rate = edf.sample_rate(select_ch[0])
+            raw_ch = edf.signals(select_ch, unit_scale=True).T * sampling_rate
+
+        # Verify that we can split into 30-s epochs
+        epoch_size = int(EPOCH_SEC_SIZE * sampling_rate)
+        if len(raw_ch) % epoch_size != 0:
+            raise Exception("Something wrong: {} samples are not a whole number of epochs".format(len(raw_ch)))
+
+        # Get epochs and their corresponding labels
+        x = raw_ch.reshape(-1, epoch_size, len(select_ch)).astype(np.float32)
+        y = labels
+        assert len(x) == len(y), "{} epochs but {} labels".format(len(x), len(y))
+
+        # Select on sleep periods
+        w_edge_mins = 30
+        nw_idx = np.where(y != 0)[0]
+        start_idx = max(nw_idx[0] - (w_edge_mins * 2), 0)
+        end_idx = min(nw_idx[-1] + (w_edge_mins * 2), len(y) - 1)
+        x = x[start_idx:end_idx + 1]
+        y = y[start_idx:end_idx + 1]
+
+        # Saving as numpy files
+        path = os.path.join(output_dir, filename)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, x=x, y=y, fs=sampling_rate)
+        os.replace(tmp, path)
+        entry["epochs"] = len(y)
+        entry["channels"] = select_ch
+    except Exception as e:
+        entry["status"] = "error"
+        entry["error"] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        entry["seconds"] = round(time.time() - start, 2)
+    return entry
+
+
+def load_manifest(output_dir):
+    '''Latest manifest entry of every file converted so far'''
+    entries = {}
+    path = os.path.join(output_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    entries[entry["file"]] = entry
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert SHHS EDF recordings to npz epochs")
+    parser.add_argument("--data_dir", type=str, default='/scratch/SLEEP_data/shhs/polysomnography/edfs/shhs1')
+    parser.add_argument("--ann_dir", type=str, default='/scratch/SLEEP_data/shhs/polysomnography/annotations-events-profusion/shhs1')
+    parser.add_argument("--output_dir", type=str, default='/scratch/SLEEP_data/shhs/output')
+    parser.add_argument("--csv_path", type=str, default='/scratch/SLEEP_data/selected_shhs1_files.txt',
+                        help="Recording ids to convert, one per line")
+    parser.add_argument("--select_ch", type=str, default='EEG C4-A1',
+                        help="Channel type to read, EEG out of 'EEG C4-A1'")  #EEG (sec)	C3	A2  #EEG	C4	A1
+    parser.add_argument("--n_channels", type=int, default=1,
+                        help="Number of matching channels kept, 1 keeps EEG (C4-A1), 2 also EEG(sec)")
+    parser.add_argument("--reader", type=str, default="edf", choices=["edf", "mne"],
+                        help="edf memory maps only the selected channels, mne uses read_raw_edf")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Recordings converted in parallel")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    ids = pd.read_csv(args.csv_path, header=None)
+    ids = sorted(ids[0].values.tolist())
+
+    # Reruns skip finished work, a file is only done once its output was renamed into
+    # place and its entry written. Files that failed are tried again.
+    manifest = load_manifest(args.output_dir)
+    finished = {"done", "faulty"}
+    ch_type = args.select_ch.split(" ")[0]
+    jobs = []
+    for i in ids:
+        entry = manifest.get(i + ".npz")
+        if entry is not None and entry["status"] in finished:
+            if entry["status"] != "done" or os.path.exists(os.path.join(args.output_dir, i + ".npz")):
+                continue
+        jobs.append((os.path.join(args.data_dir, i + ".edf"),
+                     os.path.join(args.ann_dir, i + "-profusion.xml"),
+                     args.output_dir, ch_type, args.n_channels, args.reader))
+    print("{} of {} recordings to convert".format(len(jobs), len(ids)))
+
+    counts = {"done": 0, "faulty": 0, "error": 0}
+    with open(os.path.join(args.output_dir, MANIFEST), "a") as manifest_file, \
+            mp.Pool(max(1, min(args.workers, len(jobs)))) as pool:
+        for entry in pool.imap_unordered(convert_recording, jobs):
+            manifest_file.write(json.dumps(entry) + "\n")
+            manifest_file.flush()
+            counts[entry["status"]] += 1
+            if entry["status"] == "done":
+                print("{}: {} epochs in {:.1f}s".format(entry["file"], entry["epochs"], entry["seconds"]))
+            elif entry["status"] == "faulty":
+                print("{}: ============================== Faulty file ==================".format(entry["file"]))
+            else:
+                print("{}: {}".format(entry["file"], entry["error"]))
+    print(counts)
+
 
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
 from tqdm import tqdm
 
 import mne, os
@@ -11,7 +12,6 @@ from braindecode.datautil.windowers import create_windows_from_events
 from braindecode.datautil.preprocess import zscore
 from braindecode.datasets import BaseConcatDataset, BaseDataset
 
-from torch.utils.data import DataLoader
 from torch.utils.data.sampler import Sampler
 from sklearn.utils import check_random_state
 
@@ -20,7 +20,6 @@ DATA_PATH = '/scratch/'
 os.makedirs(PATH, exist_ok=True)
 
 # Params
-BATCH_SIZE = 1
 POS_MIN = 1
 NEG_MIN = 15
 EPOCH_LEN = 7
@@ -222,8 +221,7 @@ class TuneDataset(BaseConcatDataset):
 
     def __getitem__(self, index):
 
-        X = super().__getitem__(index)[0]
-        y = super().__getitem__(index)[1]
+        X, y = super().__getitem__(index)[:2]
 
         return X, y
 
@@ -263,6 +261,19 @@ class RecordingSampler(Sampler):
 
 
 class RelativePositioningSampler(RecordingSampler):
+    """Pairs every anchor window with a negative window.
+
+    The window indices and start samples of each recording are kept as NumPy arrays.
+    The first and last epoch_len // 2 windows of a recording are never anchors, so their
+    context stays inside the recording, and the last recording of the dataset drops
+    epoch_len // 2 + 1 more. Negatives are drawn uniformly among the windows at least
+    tau_neg samples away from the anchor, within [epoch_len // 2, -(epoch_len // 2 + 1)]
+    of the anchor windows. Both intervals are found with searchsorted and the negatives of
+    all anchors are drawn in one call, so an iteration is deterministic under random_state.
+    With same_rec_neg False, negatives are drawn uniformly among the windows of the other
+    recordings in the same range instead, tau_neg does not apply across recordings.
+    """
+
     def __init__(
         self,
         metadata,
@@ -280,48 +291,71 @@ class RelativePositioningSampler(RecordingSampler):
         self.epoch_len = epoch_len
         self.n_examples = n_examples
         self.same_rec_neg = same_rec_neg
-        self.info['index'] = self.info['index'].apply(lambda x: x[self.epoch_len // 2 : -(self.epoch_len // 2) ])
-        self.info['i_start_in_trial'] = self.info['i_start_in_trial'].apply(lambda x: x[self.epoch_len // 2 : -(self.epoch_len // 2) ])
-        self.info.iloc[-1]['index'] = self.info.iloc[-1]['index'][:-(7 // 2) - 1]
-        self.info.iloc[-1]['i_start_in_trial'] = self.info.iloc[-1]['i_start_in_trial'][: -(self.epoch_len // 2) - 1]
+
+        half = self.epoch_len // 2
+        self.windows = [np.asarray(x)[half:-half] for x in self.info["index"]]
+        self.starts = [np.asarray(x)[half:-half] for x in self.info["i_start_in_trial"]]
+        self.windows[-1] = self.windows[-1][:-half - 1]
+        self.starts[-1] = self.starts[-1][:-half - 1]
+        if not self.same_rec_neg and len(self.windows) < 2:
+            raise ValueError("negatives from other recordings need at least two recordings")
+
+    def _negative_intervals(self):
+        """Per anchor: window array offset and the [lo, left) and [right, hi) candidates."""
+        half = self.epoch_len // 2
+        offsets, lo, left, right, hi = [], [], [], [], []
+        base = 0
+        for ts in self.starts:
+            first, last = half, len(ts) - (half + 1)  # positions of epoch_min and epoch_max
+            left.append(np.clip(np.searchsorted(ts, ts - self.tau_neg, side="right"), first, last + 1))
+            right.append(np.clip(np.searchsorted(ts, ts + self.tau_neg, side="left"), first, last + 1))
+            lo.append(np.full(len(ts), first))
+            hi.append(np.full(len(ts), last + 1))
+            offsets.append(np.full(len(ts), base))
+            base += len(ts)
+        return [np.concatenate(a) for a in (offsets, lo, left, right, hi)]
+
+    def _other_recording_negatives(self):
+        """Negative of every anchor, uniform over the windows of the other recordings"""
+        half = self.epoch_len // 2
+        candidates = [w[half:len(w) - half] for w in self.windows]
+        sizes = np.array([len(c) for c in candidates])
+        block = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+        rec = np.repeat(np.arange(len(self.windows)), [len(w) for w in self.windows])
+        if np.any(sizes.sum() - sizes[rec] <= 0):
+            raise ValueError("no window of another recording for some anchor")
+
+        # draw among the candidates outside the anchor's recording, then skip its block
+        draw = self.rng.randint(0, sizes.sum() - sizes[rec])
+        draw = draw + np.where(draw >= block[rec], sizes[rec], 0)
+        return np.concatenate(candidates)[draw]
 
     def _sample_pair(self):
-        
         """Sample a pair of two windows."""
-        # Sample first window
-        
-        for rec_id in range(self.info.shape[0]):
-            epochs = self.info.iloc[rec_id]["index"]
-            start_trail = self.info.iloc[rec_id]["i_start_in_trial"]
-            for ep_id, trail in zip(epochs, start_trail):
-               
-                win_ind1, rec_ind1 = ep_id, rec_id
-                ts1 = trail
-                ts = self.info.iloc[rec_ind1]["i_start_in_trial"]
-
-                epoch_min = self.info.iloc[rec_ind1]["i_start_in_trial"][self.epoch_len // 2]
-                epoch_max = self.info.iloc[rec_ind1]["i_start_in_trial"][-self.epoch_len // 2]
-
-                if self.same_rec_neg:
-                    mask = ((ts <= ts1 - self.tau_neg) & (ts >= epoch_min)) | (
-                        (ts >= ts1 + self.tau_neg) & (ts <= epoch_max)
-                    )
-                    
-                if sum(mask) == 0:
-                    raise NotImplementedError
-                win_ind2 = self.rng.choice(self.info.iloc[rec_ind1]["index"][mask])
-                yield win_ind1,win_ind2
-
-    def __iter__(self):  
+        windows = np.concatenate(self.windows)
+        if not self.same_rec_neg:
+            for win_ind1, win_ind2 in zip(windows, self._other_recording_negatives()):
+                yield win_ind1, win_ind2
+            return
+        offsets, lo, left, right, hi = self._negative_intervals()
+
+        n_left = left - lo
+        n_total = n_left + (hi - right)
+        if np.any(n_total <= 0):
+            raise ValueError("no window is tau_neg away from some anchor")
+
+        draw = self.rng.randint(0, n_total)
+        pos = np.where(draw < n_left, lo + draw, right + draw - n_left)
+        for win_ind1, win_ind2 in zip(windows, windows[offsets + pos]):
+            yield win_ind1, win_ind2
+
+    def __iter__(self):
         yield from self._sample_pair()
-      
+
     def __len__(self):
-        epoch_len = 0
-        for rec_id in range(self.info.shape[0]):
-            epoch_len += len(self.info.iloc[rec_id]["index"])
-        return epoch_len
-    
-    
+        return sum(len(w) for w in self.windows)
+
+
 ######################################################################################################################
 
 
@@ -342,9 +376,38 @@ splitted["pretext"] = RelativePositioningDataset(
 
 splitted["test"] = [ds for ds in windows_dataset.datasets if ds.description["subject"] in sub_test]
 
-for sub in splitted["test"]:
-    temp_path = os.path.join(TEST_PATH, str(sub.description["subject"]) + str(sub.description["recording"])+'.npz')
-    np.savez(temp_path, **sub.__dict__)
+
+def recording_name(ds):
+    return str(ds.description["subject"]) + str(ds.description["recording"])
+
+
+def recording_windows(ds):
+    """(n_windows, channels, 3000) float32 windows of a preloaded recording, in one read."""
+    return ds.windows.get_data().astype(np.float32)
+
+
+def export_pretext(ds_id):
+    # One contiguous shard per recording, the 7 epoch context blocks are sliced out of
+    # it by pretext_data at load time instead of being written once per anchor.
+    ds = splitted["pretext"].datasets[ds_id]
+    shard = recording_name(ds) + ".npy"
+    np.save(os.path.join(PRETEXT_PATH, shard), recording_windows(ds))
+    return shard
+
+
+def export_test(ds_id):
+    ds = splitted["test"][ds_id]
+    new_dat = dict()
+    new_dat['_description'] = [str(ds.description["subject"])]
+    new_dat['windows'] = recording_windows(ds)
+    new_dat['y'] = np.asarray(ds.y).astype('int')
+
+    # Written under a name without .npz, so subject_store never lists a partial write
+    temp_path = os.path.join(TEST_PATH, recording_name(ds) + '.npz')
+    with open(temp_path + ".tmp", "wb") as f:
+        np.savez(f, **new_dat)
+    os.replace(temp_path + ".tmp", temp_path)
+
 
 ########################################################################################################################
 
@@ -364,18 +427,25 @@ pretext_sampler = RelativePositioningSampler(
     random_state=random_state  # Same samples for every iteration of dataloader
 )
 
-
-# Dataloader
-pretext_loader = DataLoader(
-    splitted["pretext"],
-    batch_size=BATCH_SIZE,
-    sampler=pretext_sampler
-)
-
-print(f'Number of pretext epochs: {len(pretext_loader)}')
-
-for i, arr in tqdm(enumerate(pretext_loader), desc = 'pretext'):
-    temp_path = os.path.join(PRETEXT_PATH, str(i) + '.npz')
-    np.savez(temp_path, pos = arr[0].numpy().squeeze(0))
-  
-
+# Anchor windows of the sampler as (recording, epoch within the recording)
+anchors = np.array([pos for pos, _ in pretext_sampler])
+cumulative = np.asarray(splitted["pretext"].cumulative_sizes)
+shard_ids = np.searchsorted(cumulative, anchors, side="right")
+centres = anchors - np.concatenate([[0], cumulative[:-1]])[shard_ids]
+
+print(f'Number of pretext epochs: {len(anchors)}')
+
+# Recordings are exported in parallel, the forked workers share the preloaded windows
+with mp.Pool(n_jobs) as pool:
+    shards = list(tqdm(pool.imap(export_pretext, range(len(splitted["pretext"].datasets))),
+                       total=len(splitted["pretext"].datasets), desc='pretext'))
+    np.savez(
+        os.path.join(PRETEXT_PATH, "index.npz"),
+        shards=np.array(shards),
+        shard_ids=shard_ids,
+        centres=centres,
+        half_window=EPOCH_LEN // 2,
+    )
+
+    list(tqdm(pool.imap_unordered(export_test, range(len(splitted["test"]))),
+              total=len(splitted["test"]), desc='test'))
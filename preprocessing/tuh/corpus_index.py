@@ -0,0 +1,227 @@
+"""Persistent metadata index of the EDF files of the TUH corpus.
+
+Discovering the corpus used to glob the whole tree and open every file again for its
+age and gender. The index keeps one SQLite row per EDF file with its path, mtime, size,
+session, pathology label, age, gender, channel list and sampling rate. It is built by
+reading the EDF headers in a process pool and refreshed incrementally, only files whose
+mtime or size changed are read again. Building a dataset is then a query.
+
+This file can also be imported as a module and contains the following:
+
+    * read_edf_header - Metadata of a TUH EDF file from its header.
+    * corpus_index - SQLite index of the EDF files under a directory.
+"""
+__author__ = "Likith Reddy, Vamsi Kumar"
+__version__ = "1.0.0"
+__email__ = "likith012@gmail.com, vamsi81523@gmail.com"
+
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+from typing import Callable, Dict, List, Optional
+
+COLUMNS = ["path", "mtime", "size", "session", "pathological", "age", "gender",
+           "channels", "sfreq", "n_records", "record_length"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    session TEXT,
+    pathological INTEGER,
+    age INTEGER,
+    gender TEXT,
+    channels TEXT,
+    sfreq REAL,
+    n_records INTEGER,
+    record_length REAL
+)
+"""
+
+
+def read_edf_header(path: str) -> Dict:
+    """Index row of an EDF file, read from its header and its path.
+
+    Only the fixed header and the signal headers are read. age and gender are None if
+    the patient field does not hold them, sfreq is the highest channel rate (the rate
+    MNE loads the file at).
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        fixed = f.read(256)
+        n_channels = int(fixed[252:256].decode("ascii"))
+        signals = f.read(256 * n_channels).decode("latin-1")
+
+    patient_id = fixed[8:88].decode("latin-1")
+    age = re.findall(r"Age:(\d+)", patient_id)
+    gender = re.findall(r"\s(\w)\s", patient_id)
+    n_records = int(fixed[236:244].decode("ascii"))
+    record_length = float(fixed[244:252].decode("ascii"))
+
+    # labels are the first 16 bytes and samples per record the 9th 8 byte field of
+    # the signal headers
+    labels = [signals[16 * i:16 * (i + 1)].strip() for i in range(n_channels)]
+    offset = n_channels * (16 + 80 + 8 + 8 * 4 + 80)
+    n_samples = [int(signals[offset + 8 * i:offset + 8 * (i + 1)]) for i in range(n_channels)]
+
+    path_splits = path.split("/")
+    if "abnormal" in path_splits:
+        pathological = 1
+    elif "normal" in path_splits:
+        pathological = 0
+    else:
+        pathological = None
+    session = "train" if "train" in path_splits else "eval" if "eval" in path_splits else None
+
+    return {
+        "path": path,
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "session": session,
+        "pathological": pathological,
+        "age": int(age[0]) if age else None,
+        "gender": gender[0] if gender else None,
+        "channels": json.dumps(labels),
+        "sfreq": max(n_samples) / record_length if record_length > 0 else None,
+        "n_records": n_records,
+        "record_length": record_length,
+    }
+
+
+def _read_header(path: str) -> Optional[Dict]:
+    try:
+        return read_edf_header(path)
+    except (OSError, ValueError, IndexError, UnicodeDecodeError):
+        return None
+
+
+class corpus_index(object):
+    """
+    Class for the SQLite metadata index of a corpus of EDF files
+
+    Attributes:
+    -----------
+        db_path: str
+            SQLite file of the index, created if missing
+        n_jobs: int, optional
+            processes reading headers during a refresh
+
+    Methods:
+    --------
+        refresh: str -> dict
+            brings the rows of the files under a directory up to date
+        files: -> list of dict
+            rows matching a query, optionally sorted by a path key
+        paths: -> list of str
+            paths of the rows matching a query
+
+    """
+
+    def __init__(self, db_path: str, n_jobs: int = os.cpu_count()):
+        self.db_path = db_path
+        self.n_jobs = n_jobs
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+
+    @staticmethod
+    def _root(directory: str) -> str:
+        return os.path.join(os.path.abspath(directory), "")
+
+    def _scan(self, directory: str, extension: str) -> Dict[str, tuple]:
+        # (mtime, size) of every file, from the directory entries without opening files
+        found = {}
+        stack = [directory]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(extension):
+                        stat = entry.stat()
+                        found[entry.path] = (stat.st_mtime, stat.st_size)
+        return found
+
+    def refresh(self, directory: str, extension: str = ".edf") -> Dict[str, int]:
+        """Adds new files, re-reads files whose mtime or size changed and drops deleted ones"""
+        root = self._root(directory)
+        found = self._scan(root, extension)
+        known = {row["path"]: (row["mtime"], row["size"]) for row in self.conn.execute(
+            "SELECT path, mtime, size FROM files WHERE substr(path, 1, ?) = ?",
+            (len(root), root))}
+
+        stale = sorted(p for p, stat in found.items() if known.get(p) != stat)
+        deleted = [p for p in known if p not in found]
+
+        rows, failed = [], 0
+        if stale:
+            with multiprocessing.Pool(max(1, min(self.n_jobs, len(stale)))) as pool:
+                for row in pool.imap_unordered(_read_header, stale, chunksize=64):
+                    if row is None:
+                        failed += 1
+                    else:
+                        rows.append(row)
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in deleted])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+                    ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [tuple(row[c] for c in COLUMNS) for row in rows])
+        return {"files": len(found), "updated": len(rows), "deleted": len(deleted),
+                "failed": failed}
+
+    def files(
+        self,
+        directory: Optional[str] = None,
+        session: Optional[str] = None,
+        pathological: Optional[bool] = None,
+        channel: Optional[str] = None,
+        key: Optional[Callable[[str], list]] = None,
+    ) -> List[Dict]:
+        """Rows under directory with the given session, label and channel, sorted by key(path)"""
+        query, params = "SELECT * FROM files WHERE 1", []
+        if directory is not None:
+            root = self._root(directory)
+            query += " AND substr(path, 1, ?) = ?"
+            params += [len(root), root]
+        if session is not None:
+            query += " AND session = ?"
+            params.append(session)
+        if pathological is not None:
+            query += " AND pathological = ?"
+            params.append(int(pathological))
+
+        rows = []
+        for row in self.conn.execute(query, params):
+            row = dict(row)
+            row["channels"] = json.loads(row["channels"])
+            if channel is None or any(channel in ch for ch in row["channels"]):
+                rows.append(row)
+        rows.sort(key=lambda row: row["path"] if key is None else key(row["path"]))
+        return rows
+
+    def paths(self, directory: Optional[str] = None, **kwargs) -> List[str]:
+        return [row["path"] for row in self.files(directory, **kwargs)]
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build or refresh the TUH EDF index")
+    parser.add_argument("dirs", nargs="+", help="Corpus directories to index")
+    parser.add_argument("--db", type=str, default="/scratch/tuh/edf_index.sqlite")
+    parser.add_argument("--n_jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    index = corpus_index(args.db, n_jobs=args.n_jobs)
+    for directory in args.dirs:
+        print(directory, index.refresh(directory))
+    index.close()
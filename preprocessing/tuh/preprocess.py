@@ -19,6 +19,8 @@ import os
 import shutil
 import multiprocessing
 
+from corpus_index import corpus_index
+
 mne.set_log_level('WARNING')
 
 class TUHAbnormal(BaseConcatDataset):
@@ -33,11 +35,31 @@ class TUHAbnormal(BaseConcatDataset):
         can be 'pathological', 'gender', or 'age'
     preload: bool
         if True, preload the data of the Raw objects.
+    index_path: str | None
+        SQLite corpus index (see corpus_index.py). Files, age and gender are then
+        queried from it instead of crawling the tree and reading every header.
+        The index is only built if it has no files under path yet.
+    refresh: bool
+        if True, bring the index up to date with path first (a walk of the whole
+        tree, re-reading the headers of new or changed files). Otherwise refresh
+        it explicitly with corpus_index.py when the corpus changes.
     """
-    def __init__(self, path, subject_ids=None, target_name="pathological",preload=False):
+    def __init__(self, path, subject_ids=None, target_name="pathological",preload=False,
+                 index_path=None, refresh=False):
         
-        all_file_paths = read_all_file_names(path, extension='.edf', key=self._time_key)
-        breakpoint()
+        headers = None
+        if index_path is not None:
+            index = corpus_index(index_path)
+            rows = [] if refresh else index.files(path, key=self._time_key)
+            if len(rows) == 0:
+                index.refresh(path)
+                rows = index.files(path, key=self._time_key)
+            index.close()
+            assert len(rows) > 0, f"something went wrong. Found no .edf files in {path}"
+            headers = {row['path']: row for row in rows}
+            all_file_paths = [row['path'] for row in rows]
+        else:
+            all_file_paths = read_all_file_names(path, extension='.edf', key=self._time_key)
         
         if subject_ids is None:
             subject_ids = np.arange(len(all_file_paths))
@@ -49,13 +71,11 @@ class TUHAbnormal(BaseConcatDataset):
         all_base_ds = []
         for subject_id in subject_ids:
             file_path = all_file_paths[subject_id]
-            raw = mne.io.read_raw_edf(file_path, preload=preload)
-            chs = raw.ch_names
-            exclude_ch = []
-            for ch in chs:
-                if 'CZ-REF' not in ch:
-                    exclude_ch.append(ch)
-            raw = mne.io.read_raw_edf(file_path, preload=preload,exclude=exclude_ch)
+            # open once without data, keep CZ from the header and only then load it
+            raw = mne.io.read_raw_edf(file_path, preload=False)
+            raw.pick([ch for ch in raw.ch_names if 'CZ-REF' in ch])
+            if preload:
+                raw.load_data()
             path_splits = file_path.split("/")
             if "abnormal" in path_splits:
                 pathological = True
@@ -67,7 +87,10 @@ class TUHAbnormal(BaseConcatDataset):
             else:
                 assert "eval" in path_splits
                 session = "eval"
-            age, gender = _parse_age_and_gender_from_edf_header(file_path)
+            if headers is not None:
+                age, gender = headers[file_path]['age'], headers[file_path]['gender']
+            else:
+                age, gender = _parse_age_and_gender_from_edf_header(file_path)
             description = pd.Series(
                 {'age': age, 'pathological': pathological, 'gender': gender,
                 'session': session, 'subject': subject_id}, name=subject_id)
@@ -87,7 +110,7 @@ class TUHAbnormal(BaseConcatDataset):
         session_id = re.findall(r'(s\d*)_', (splits[-2]))
         return date_id + session_id + recording_id
 
-# TODO: this is very slow. how to improve?
+# Slow on the whole corpus, TUHAbnormal queries corpus_index instead when given index_path
 def read_all_file_names(directory, extension, key):
     """Read all files with specified extension from given path and sorts them
     based on a given sorting key.
@@ -132,7 +155,8 @@ def _parse_age_and_gender_from_edf_header(file_path, return_raw_header=False):
     return int(age), gender
     
     
-def load_example_data(TUH_PATH,preload, window_len_s, n_subjects=None,n_jobs=1):
+def load_example_data(TUH_PATH,preload, window_len_s, n_subjects=None,n_jobs=1,index_path=None,
+                      refresh_index=False):
     """Create windowed dataset from subjects of the TUH Abnormal dataset.
 
     Parameters
@@ -159,7 +183,7 @@ def load_example_data(TUH_PATH,preload, window_len_s, n_subjects=None,n_jobs=1):
         
     ds = TUHAbnormal(
         TUH_PATH, subject_ids=subject_ids, target_name='pathological',
-        preload=preload)
+        preload=preload, index_path=index_path, refresh=refresh_index)
 
     fs = ds.datasets[0].raw.info['sfreq']
     window_len_samples = int(fs * window_len_s)
@@ -184,6 +208,7 @@ train_path = '/scratch/tuh/edf/train/'
 eval_path = '/scratch/tuh/edf/eval/'
 train_save_path = '/scratch/allsamples_tuh/train'
 test_save_path = '/scratch/allsamples_tuh/test'
+index_path = '/scratch/tuh/edf_index.sqlite'  # refresh with: python corpus_index.py <dirs>
 
 
 if os.path.exists('/scratch/allsamples_tuh'):
@@ -193,26 +218,36 @@ os.mkdir('/scratch/allsamples_tuh')
 os.mkdir(train_save_path)
 os.mkdir(test_save_path)
 
-train_dataset = load_example_data(train_path,preload=False,window_len_s=30,n_jobs=12)
-eval_dataset = load_example_data(eval_path,preload=False,window_len_s=30,n_jobs=12)
-
-def multi_fc(save_path,ds,start_subject,end_subject):
-    for j in tqdm(range(start_subject,end_subject)):
-        subject_ds = ds.datasets[j]
-        end = len(subject_ds)
-        dct = {}
-        dct['x'] = []
-        dct['y'] = []
-        for i in range(0,end):
-            sub = ds[i]
-            dct['x'].append(torch.nn.functional.interpolate(torch.tensor(sub[0]).unsqueeze(0),scale_factor=3000/7500).numpy().squeeze(0))
-            dct['y'].append(sub[1])
-
-        dct['x'] = np.array(dct['x'])
-        dct['y'] = np.array(dct['y'])
-        dct['x'] = np.transpose(dct['x'],(0,2,1))
-        temp_path = os.path.join(save_path, "subject_"+str(i) +'.npz')
-        np.savez(temp_path, **dct)
-
-multi_fc(train_save_path,train_dataset,0,len(train_dataset.datasets))
-multi_fc(test_save_path,eval_dataset,0,len(eval_dataset.datasets))
+train_dataset = load_example_data(train_path,preload=False,window_len_s=30,n_jobs=12,index_path=index_path)
+eval_dataset = load_example_data(eval_path,preload=False,window_len_s=30,n_jobs=12,index_path=index_path)
+
+def export_subject(job):
+    """Writes all windows of one subject to <save_path>/subject_<id>.npz.
+
+    The windows are read with a single get_data call and resampled from 7500 to 3000
+    samples in one batched interpolate, x is (n_windows, 3000, channels).
+    """
+    save_path, split, j = job
+    subject_ds = datasets[split].datasets[j]
+    x = subject_ds.windows.get_data().astype(np.float32)
+    x = torch.nn.functional.interpolate(torch.from_numpy(x), scale_factor=3000/7500).numpy()
+    dct = {}
+    dct['x'] = np.transpose(x,(0,2,1))
+    dct['y'] = subject_ds.windows.metadata['target'].to_numpy()
+    temp_path = os.path.join(save_path, "subject_"+str(subject_ds.description['subject']) +'.npz')
+    with open(temp_path + '.tmp', 'wb') as f:
+        np.savez(f, **dct)
+    os.replace(temp_path + '.tmp', temp_path)
+    return len(x)
+
+
+def multi_fc(save_path,split,start_subject,end_subject,n_jobs=12):
+    # subjects are exported in parallel, the forked workers share the lazy datasets
+    jobs = [(save_path, split, j) for j in range(start_subject,end_subject)]
+    with multiprocessing.Pool(n_jobs) as pool:
+        return sum(tqdm(pool.imap_unordered(export_subject, jobs), total=len(jobs)))
+
+
+datasets = {'train': train_dataset, 'eval': eval_dataset}
+multi_fc(train_save_path,'train',0,len(train_dataset.datasets))
+multi_fc(test_save_path,'eval',0,len(eval_dataset.datasets))
@@ -15,6 +15,8 @@ class attention(nn.Module):
     --------
         forward: torch.Tensor -> torch.Tensor
             forward pass of the attention module
+        inference: torch.Tensor -> torch.Tensor
+            forward pass without autograd state
 
     """
 
@@ -26,16 +28,17 @@ class attention(nn.Module):
         self.scale = self.att_dim**-0.5
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        e = torch.matmul(x, self.W)
-        e = torch.matmul(torch.tanh(e), self.V)
-        e = e * self.scale
-        n1 = torch.exp(e)
-        n2 = torch.sum(torch.exp(e), 1, keepdim=True)
-        alpha = torch.div(n1, n2)
-        x = torch.sum(torch.mul(alpha, x), 1)
+        # x: (B, C, T), scores over T from a single softmax, computed in float32 so
+        # large scores cannot overflow under autocast
+        e = torch.matmul(torch.tanh(torch.matmul(x.transpose(1, 2), self.W)), self.V)
+        alpha = torch.softmax(e.float() * self.scale, dim=1)  # B, T, 1
+        x = torch.bmm(x, alpha.to(x.dtype)).squeeze(-1)  # B, C
         return x
 
+    @torch.inference_mode()
+    def inference(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x)
+
 
 class encoder(nn.Module):
     """
@@ -58,7 +61,7 @@ class encoder(nn.Module):
         self.time_model = BaseNet()
         self.attention = attention()
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
 
         time = self.time_model(x)
         time_feats = self.attention(time)
@@ -123,6 +126,10 @@ class sleep_model(nn.Module):
         self.curr_pj = projection_head(config)
 
         self.config = config
+        # position of the centre epoch among the epochs the dataset returns
+        self.centre = config.epoch_len // 2
+        if config.pretext_epochs is not None:
+            self.centre = list(config.pretext_epochs).index(self.centre)
 
     def forward(
         self, weak_dat: torch.Tensor, strong_dat: torch.Tensor
@@ -132,11 +139,9 @@ class sleep_model(nn.Module):
         strong_eeg_dat = strong_dat.float()
 
         weak_curr_feats = self.eeg_encoder(
-            weak_eeg_dat[:, (self.config.epoch_len //
-                             2):(self.config.epoch_len // 2) + 1, :])
+            weak_eeg_dat[:, self.centre:self.centre + 1, :])
         strong_curr_feats = self.eeg_encoder(
-            strong_eeg_dat[:, (self.config.epoch_len //
-                               2):(self.config.epoch_len // 2) + 1, :])
+            strong_eeg_dat[:, self.centre:self.centre + 1, :])
 
         weak_curr_feats, strong_curr_feats = self.curr_pj(
             weak_curr_feats), self.curr_pj(strong_curr_feats)
@@ -20,9 +20,11 @@ class Config(object):
         self.degree = 0.05
         self.mask_max_points = 200
         self.mask_min_points = 50
+        self.augment_on_device = False  # augment in training_step instead of the DataLoader
 
         # epoch
         self.epoch_len = 7
+        self.pretext_epochs = [self.epoch_len // 2]  # context epochs the model consumes, all if None
 
         # time domain
         self.tc_hidden_dim = 128
@@ -48,3 +50,11 @@ class Config(object):
         self.drop_last = True
         self.lambda1 = 1
         self.splits = 5
+        self.kfold_workers = 1  # folds evaluated in parallel single-threaded CPU processes, sequential if 1 or on a GPU
+        self.kfold_seed = 1234  # fold i is seeded with kfold_seed + i, sequential or parallel
+        self.async_eval = False  # queue encoder snapshots for eval_worker.py instead of evaluating inline
+        self.eval_queue_path = None  # snapshot queue directory, <exp_path>/eval_queue if None
+        self.run_id = None  # tags the DONE marker and _best.pt of a run, passed to train.py and eval_worker.py as --run_id
+        self.cache_embeddings = False  # linear evaluation on frozen encoder features computed once
+        self.embedding_cache_path = None  # on-disk feature cache, in memory only if None
+        self.subject_cache_path = None  # memory-mapped .npy copy of the evaluation records
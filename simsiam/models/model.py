@@ -15,6 +15,8 @@ class attention(nn.Module):
     --------
         forward: torch.Tensor -> torch.Tensor
             forward pass of the attention module
+        inference: torch.Tensor -> torch.Tensor
+            forward pass without autograd state
 
     """
 
@@ -26,16 +28,17 @@ class attention(nn.Module):
         self.scale = self.att_dim**-0.5
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = x.permute(0, 2, 1)
-        e = torch.matmul(x, self.W)
-        e = torch.matmul(torch.tanh(e), self.V)
-        e = e * self.scale
-        n1 = torch.exp(e)
-        n2 = torch.sum(torch.exp(e), 1, keepdim=True)
-        alpha = torch.div(n1, n2)
-        x = torch.sum(torch.mul(alpha, x), 1)
+        # x: (B, C, T), scores over T from a single softmax, computed in float32 so
+        # large scores cannot overflow under autocast
+        e = torch.matmul(torch.tanh(torch.matmul(x.transpose(1, 2), self.W)), self.V)
+        alpha = torch.softmax(e.float() * self.scale, dim=1)  # B, T, 1
+        x = torch.bmm(x, alpha.to(x.dtype)).squeeze(-1)  # B, C
         return x
 
+    @torch.inference_mode()
+    def inference(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward(x)
+
 
 class encoder(nn.Module):
     """
@@ -58,7 +61,7 @@ class encoder(nn.Module):
         self.time_model = BaseNet()
         self.attention = attention()
 
-    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
 
         time = self.time_model(x)
 
@@ -112,10 +115,14 @@ class sleep_model(nn.Module):
         self.proj = projection_head(config)
         self.pred = predictor_head(config)
         self.config = config
+        # position of the centre epoch among the epochs the dataset returns
+        self.centre = config.epoch_len // 2
+        if config.pretext_epochs is not None:
+            self.centre = list(config.pretext_epochs).index(self.centre)
 
     def forward(self, weak_data, strong_data):
-        weak_data= self.eeg_encoder(weak_data[:, (self.config.epoch_len // 2):(self.config.epoch_len // 2) + 1, :])
-        strong_data= self.eeg_encoder(strong_data[:, (self.config.epoch_len // 2):(self.config.epoch_len // 2) + 1, :])
+        weak_data= self.eeg_encoder(weak_data[:, self.centre:self.centre + 1, :])
+        strong_data= self.eeg_encoder(strong_data[:, self.centre:self.centre + 1, :])
 
         proj1 = self.proj(weak_data)
         pred1 = self.pred(proj1)
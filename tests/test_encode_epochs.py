@@ -0,0 +1,52 @@
+"""Folded encoding of the context epochs against the per-epoch loop, for every CARE copy."""
+import glob
+import importlib
+import os
+import sys
+
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METHODS = sorted(os.path.basename(os.path.dirname(os.path.dirname(p)))
+                 for p in glob.glob(os.path.join(ROOT, "*", "models", "model.py"))
+                 if "def check_encode_epochs" in open(p).read())
+
+
+@pytest.fixture(params=METHODS)
+def method(request):
+    """config and models.model of one method directory, imported as train.py does"""
+    def purge():
+        for name in list(sys.modules):
+            if name in ("config", "models") or name.startswith("models."):
+                del sys.modules[name]
+
+    purge()
+    sys.path.insert(0, os.path.join(ROOT, request.param))
+    try:
+        yield importlib.import_module("config"), importlib.import_module("models.model")
+    finally:
+        sys.path.pop(0)
+        purge()
+
+
+@pytest.mark.parametrize("epoch_len", [7, 9])
+def test_encode_epochs_matches_loop(method, epoch_len):
+    config_module, model_module = method
+    torch.manual_seed(0)
+    config = config_module.Config()
+    config.epoch_len = epoch_len
+    model = model_module.sleep_model(config)
+    data = torch.randn(3, epoch_len, 3000)
+    model.train()
+    assert model.check_encode_epochs(data)
+    assert model.training, "check_encode_epochs must restore train mode"
+
+
+def test_encode_epochs_shape(method):
+    config_module, model_module = method
+    model = model_module.sleep_model(config_module.Config()).eval()
+    eeg_encoder = getattr(model, "top_encoder", None) or model.eeg_encoder
+    with torch.no_grad():
+        feats = model.encode_epochs(eeg_encoder, torch.randn(2, 7, 3000))
+    assert feats.shape == (2, 7, 256)
@@ -0,0 +1,140 @@
+"""Whole-night and online scoring of care/inference.py against scoring every epoch on its own."""
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("config", "models", "utils", "inference", "context_head", "export", "quantize")
+
+
+@pytest.fixture
+def care():
+    """inference, context_head, config and models of care, imported as the CLI does"""
+    def purge():
+        for name in list(sys.modules):
+            if name in MODULES or name.startswith(("models.", "utils.")):
+                del sys.modules[name]
+
+    purge()
+    sys.path.insert(0, os.path.join(ROOT, "care"))
+    try:
+        yield {name: importlib.import_module(name)
+               for name in ("inference", "context_head", "config", "models.model", "models.tfr")}
+    finally:
+        sys.path.pop(0)
+        purge()
+
+
+def build(care, context, seed=0):
+    torch.manual_seed(seed)
+    eeg_encoder = care["models.model"].encoder().eval()
+    tfmr = care["models.tfr"].Transformer(256, 4, 4, 256, dropout=0.1).eval() if context else None
+    head = nn.Linear(256, 5).eval()
+    return eeg_encoder, tfmr, head
+
+
+def night(n_epochs, seed=0):
+    return np.random.default_rng(seed).standard_normal((n_epochs, 1, 3000)).astype(np.float32)
+
+
+@torch.no_grad()
+def independent_scores(x, eeg_encoder, tfmr, head, epoch_len=7):
+    """Every epoch scored on its own, its window re-encoded epoch by epoch"""
+    h = epoch_len // 2 if tfmr is not None else 0
+    probs = []
+    for i in range(x.shape[0]):
+        idx = np.clip(np.arange(i - h, i + h + 1), 0, x.shape[0] - 1)
+        feats = torch.stack([eeg_encoder(torch.from_numpy(x[j:j + 1]))[0] for j in idx])
+        feat = feats[h] if tfmr is None else tfmr(feats[None])[0]
+        probs.append(torch.softmax(head(feat), dim=-1).numpy())
+    return np.stack(probs)
+
+
+@pytest.mark.parametrize("context", [False, True])
+@pytest.mark.parametrize("n_epochs", [2, 20])
+def test_engine_matches_independent_scoring(care, context, n_epochs):
+    eeg_encoder, tfmr, head = build(care, context)
+    engine = care["inference"].hypnogram_engine(eeg_encoder, head, torch.device("cpu"),
+                                                batch_size=8, tfmr=tfmr)
+    x = night(n_epochs)
+    stages, probs = engine.score(x)
+    ref = independent_scores(x, eeg_encoder, tfmr, head)
+    np.testing.assert_allclose(probs, ref, atol=1e-5, rtol=1e-4)
+    np.testing.assert_array_equal(stages, probs.argmax(axis=-1))
+
+
+@pytest.mark.parametrize("context", [False, True])
+@pytest.mark.parametrize("n_epochs", [2, 20])
+def test_online_revised_scores_match_engine(care, context, n_epochs):
+    eeg_encoder, tfmr, head = build(care, context)
+    inference = care["inference"]
+    engine = inference.hypnogram_engine(eeg_encoder, head, torch.device("cpu"),
+                                        batch_size=8, tfmr=tfmr)
+    x = night(n_epochs)
+    _, ref = engine.score(x)
+
+    scorer = inference.online_scorer(engine)
+    final = {}
+    for i in range(n_epochs):
+        provisional, revised = scorer.push(x[i, 0])
+        assert provisional[0] == i
+        if not context:
+            # without context every score is final right away
+            assert revised is None
+            final[i] = provisional[2]
+        elif revised is not None:
+            final[revised[0]] = revised[2]
+    pending = scorer.flush()
+    assert len(pending) == (min(n_epochs, scorer.half_window) if context else 0)
+    for epoch, stage, probs in pending:
+        assert epoch not in final
+        assert stage == probs.argmax()
+        final[epoch] = probs
+
+    assert sorted(final) == list(range(n_epochs))
+    np.testing.assert_allclose(np.stack([final[i] for i in range(n_epochs)]), ref,
+                               atol=1e-5, rtol=1e-4)
+
+
+def test_context_checkpoint_round_trip(care, tmp_path):
+    inference, context_head = care["inference"], care["context_head"]
+    config = care["config"].Config()
+    config.num_ft_epoch = 3
+    eeg_encoder, tfmr, _ = build(care, context=True)
+
+    # a pretraining checkpoint holds the encoder and transformer inside contrast_loss
+    state = {"model.top_encoder." + k: v for k, v in eeg_encoder.state_dict().items()}
+    state.update({"model.top_tfmr." + k: v for k, v in tfmr.state_dict().items()})
+    torch.save({"model_state_dict": state}, tmp_path / "run_full.pt")
+    eeg_encoder, tfmr = context_head.load_context_model(str(tmp_path / "run_full.pt"), config)
+
+    engine = inference.hypnogram_engine(eeg_encoder, nn.Identity(), torch.device("cpu"),
+                                        batch_size=8, tfmr=tfmr, epoch_len=config.epoch_len)
+    records = [{"windows": night(12, seed), "y": np.arange(12) % 5} for seed in range(3)]
+    train = context_head.context_features(engine, records[:2])
+    valid = context_head.context_features(engine, records[2:])
+    assert train[0].shape == (24, 256) and not train[0].is_inference()
+    lin_state, f1 = context_head.fit_context_head(train, valid, config)
+    context_head.save_context_head(str(tmp_path / "context_head.pt"), eeg_encoder, tfmr,
+                                   lin_state, config, f1)
+
+    head = nn.Linear(256, 5)
+    head.load_state_dict(lin_state)
+    x = night(15, seed=7)
+    ref = independent_scores(x, eeg_encoder, tfmr.eval(), head.eval(), config.epoch_len)
+
+    loaded = inference.hypnogram_engine.from_checkpoint(str(tmp_path / "context_head.pt"),
+                                                        device=torch.device("cpu"))
+    assert loaded.tfmr is not None and loaded.half_window == config.epoch_len // 2
+    np.testing.assert_allclose(loaded.score(x)[1], ref, atol=1e-5, rtol=1e-4)
+
+    scorer = inference.online_scorer.from_checkpoint(str(tmp_path / "context_head.pt"),
+                                                     device=torch.device("cpu"))
+    revised = [r for r in (scorer.push(epoch[0])[1] for epoch in x) if r is not None]
+    revised += scorer.flush()
+    np.testing.assert_allclose(np.stack([p for _, _, p in revised]), ref, atol=1e-5, rtol=1e-4)
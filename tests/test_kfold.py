@@ -0,0 +1,72 @@
+"""Parallel k-fold evaluation of every method, forked after multi-threaded torch work."""
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METHODS = sorted(os.path.basename(os.path.dirname(p))
+                 for p in glob.glob(os.path.join(ROOT, "*", "helper_train.py"))
+                 if "\nclass sleep_pretrain" in open(p).read())
+
+# Runs in a fresh interpreter, so a deadlocked pool fails the test on the timeout instead of
+# hanging the session
+SCRIPT = textwrap.dedent("""
+    import json, sys
+    import torch
+    sys.path.insert(0, sys.argv[1])
+    import helper_train
+    from config import Config
+
+    # The trainer has run multi-threaded OpenMP work before it evaluates
+    torch.set_num_threads(4)
+    x = torch.randn(256, 256)
+    for _ in range(20):
+        x = torch.tanh(x @ x)
+    torch.nn.functional.conv1d(torch.randn(8, 16, 3000), torch.randn(32, 16, 7))
+
+    class trainer(object):
+        do_kfold = helper_train.sleep_pretrain.do_kfold
+
+        def __init__(self, workers):
+            self.config = Config()
+            self.config.kfold_workers = workers
+            self.test_subjects = [[i] for i in range(10)]
+
+        def ft_fun(self, train, test):
+            y = torch.randn(128, 256)
+            score = float(torch.tanh(y @ y.T).mean()) + float(torch.rand(1))
+            return score, 0.5, 0.5, 0.5, {"threads": torch.get_num_threads()}
+
+    class unscored(trainer):
+        def ft_fun(self, train, test):
+            return 0.0, 0.0, 0.0, 0.0, None
+
+    out = {}
+    for workers in (1, 2):
+        evaluator = trainer(workers)
+        out[workers] = [list(map(float, evaluator.do_kfold())), evaluator.best_fold_state]
+    evaluator = unscored(1)
+    evaluator.do_kfold()
+    out["unscored"] = evaluator.best_fold_state
+    print(json.dumps(out))
+""")
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_parallel_kfold_after_torch_work(method):
+    proc = subprocess.run([sys.executable, "-c", SCRIPT, os.path.join(ROOT, method)],
+                          capture_output=True, text=True, timeout=300,
+                          cwd=os.path.join(ROOT, method))
+    assert proc.returncode == 0, proc.stderr
+    out = json.loads(proc.stdout.strip().splitlines()[-1])
+    sequential, parallel = out["1"], out["2"]
+    # folds are seeded alike in the trainer and in the forked workers
+    assert parallel[0] == pytest.approx(sequential[0])
+    assert parallel[1] == {"threads": 1}
+    # no fold improved on an F1 of 0, so there is no head to save
+    assert out["unscored"] is None
@@ -0,0 +1,59 @@
+"""int8 quantization of the encoder of every method, whichever attribute holds its BaseNet."""
+import glob
+import importlib
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+METHODS = sorted(os.path.basename(os.path.dirname(p))
+                 for p in glob.glob(os.path.join(ROOT, "*", "quantize.py")))
+
+
+@pytest.fixture(params=METHODS)
+def method(request):
+    """config, models.model and quantize of one method directory, imported as the CLI does"""
+    def purge():
+        for name in list(sys.modules):
+            if name in ("config", "models", "utils", "export", "quantize") or \
+                    name.startswith(("models.", "utils.")):
+                del sys.modules[name]
+
+    purge()
+    sys.path.insert(0, os.path.join(ROOT, request.param))
+    try:
+        yield (importlib.import_module("config"), importlib.import_module("models.model"),
+               importlib.import_module("quantize"))
+    finally:
+        sys.path.pop(0)
+        purge()
+
+
+def test_time_model_methods_are_covered():
+    assert {"simclr", "simsiam", "simsiam_noBN", "mocov2"} <= set(METHODS)
+
+
+def test_quantize_encoder_forward(method):
+    config_module, model_module, quantize = method
+    torch.manual_seed(0)
+    try:
+        eeg_encoder = model_module.encoder(config_module.Config())
+    except TypeError:  # the CARE encoders take no config
+        eeg_encoder = model_module.encoder()
+    eeg_encoder.eval()
+    windows = np.random.default_rng(0).standard_normal((16, 1, 3000)).astype(np.float32)
+
+    int8_encoder = quantize.quantize_encoder(eeg_encoder, windows, batch_size=8)
+    attr = quantize.basenet_attr(eeg_encoder)
+    assert isinstance(getattr(int8_encoder, attr), torch.fx.GraphModule)
+    assert not isinstance(getattr(eeg_encoder, attr), torch.fx.GraphModule)
+
+    x = torch.from_numpy(windows)
+    with torch.no_grad():
+        ref, out = eeg_encoder(x), int8_encoder(x)
+    assert out.shape == ref.shape
+    assert torch.isfinite(out).all()
+    assert (out - ref).abs().max() < 0.1 * ref.abs().max()
@@ -0,0 +1,60 @@
+"""Parity of the math and sdpa attention backends of every context transformer copy."""
+import glob
+import importlib.util
+import os
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TFR_FILES = sorted(glob.glob(os.path.join(ROOT, "*", "models", "tfr.py")) +
+                   glob.glob(os.path.join(ROOT, "*", "models", "*", "tfr.py")))
+
+
+def load_tfr(path):
+    name = "tfr_" + os.path.relpath(path, ROOT).replace(os.sep, "_")[:-3]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=TFR_FILES, ids=lambda p: os.path.relpath(p, ROOT))
+def tfr(request):
+    return load_tfr(request.param)
+
+
+def masks(batch, seq_len):
+    mask = torch.rand(batch, seq_len - 1) > 0.3
+    # queries masked out attend to nothing, their outputs are undefined in both backends
+    keep = F.pad(mask, (1, 0), value=True)
+    return [(None, torch.ones_like(keep)), (mask, keep)]
+
+
+@pytest.mark.parametrize("seq_len", [7, 21, 64])
+@pytest.mark.parametrize("dropout", [0.0, 0.1])
+def test_attention_backends_match(tfr, seq_len, dropout):
+    torch.manual_seed(0)
+    attn = tfr.Attention(256, heads=4, dropout=dropout).eval()
+    x = torch.randn(8, seq_len, 256)
+    with torch.no_grad():
+        for mask, rows in masks(8, seq_len):
+            attn.backend = "math"
+            ref = attn(x, mask=mask)
+            attn.backend = "sdpa"
+            out = attn(x, mask=mask)
+            torch.testing.assert_close(out[rows], ref[rows], atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("seq_len", [7, 33])
+@pytest.mark.parametrize("dropout", [0.0, 0.1])
+def test_transformer_backends_match(tfr, seq_len, dropout):
+    torch.manual_seed(0)
+    math = tfr.Transformer(256, 4, 4, 256, dropout=dropout, backend="math").eval()
+    sdpa = tfr.Transformer(256, 4, 4, 256, dropout=dropout, backend="sdpa").eval()
+    sdpa.load_state_dict(math.state_dict())
+    x = torch.randn(4, seq_len, 256)
+    with torch.no_grad():
+        torch.testing.assert_close(sdpa(x), math(x), atol=1e-5, rtol=1e-4)
+
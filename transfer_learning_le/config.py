@@ -23,6 +23,7 @@ class Config(object):
 
         # epoch
         self.epoch_len = 7
+        self.attn_backend = "math"  # context transformer attention, the "math" reference or the fused "sdpa"
 
         # time domain
         self.tc_hidden_dim = 128
@@ -47,3 +48,8 @@ class Config(object):
         self.drop_last = True
         self.lambda1 = 1
         self.splits = 5
+        self.kfold_workers = 1  # folds evaluated in parallel single-threaded CPU processes, sequential if 1 or on a GPU
+        self.kfold_seed = 1234  # fold i is seeded with kfold_seed + i, sequential or parallel
+        self.cache_embeddings = False  # linear evaluation on frozen encoder features computed once
+        self.embedding_cache_path = None  # on-disk feature cache, in memory only if None
+        self.subject_cache_path = None  # memory-mapped .npy copy of the evaluation records
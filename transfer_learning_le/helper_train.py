@@ -1,6 +1,10 @@
+import os
 import time, math
 import torch
+import multiprocessing as mp
+from contextlib import contextmanager
 import torch.nn as nn
+import numpy as np
 import wandb
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torchmetrics.functional import accuracy, cohen_kappa
@@ -8,11 +12,46 @@ from torchmetrics.functional import f1_score as f1
 from sklearn.metrics import ConfusionMatrixDisplay, balanced_accuracy_score
 from sklearn.model_selection import KFold
 from utils.dataloader import TuneDataset
-from torch.utils.data import DataLoader
+from utils.embeddings import embedding_cache
+from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 from torch.cuda.amp import GradScaler
 
 
+# Fold state shared with the forked k-fold workers, set only while the pool runs
+_kfold_state = None
+
+
+@contextmanager
+def _fold_rng(seed):
+    """Seeds torch and numpy for one fold and restores the caller's RNG state afterwards.
+
+    Every fold starts from kfold_seed + fold, so its result does not depend on whether it
+    runs in the trainer or in a forked worker, which inherits the trainer's RNG state.
+    """
+    np_state = np.random.get_state()
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        try:
+            yield
+        finally:
+            np.random.set_state(np_state)
+
+
+def _kfold_worker(fold):
+    """Evaluates a single fold inside a forked pool process.
+
+    The child is pinned to one intra-op thread: the trainer has already run multi-threaded
+    OpenMP work before forking, and a forked child that starts its own OpenMP pool deadlocks.
+    """
+    trainer, folds = _kfold_state
+    torch.set_num_threads(1)
+    trainer.config.split = fold + 1
+    with _fold_rng(trainer.config.kfold_seed + fold):
+        return trainer.ft_fun(*folds[fold])
+
+
 def run(config,name,test_subjects):
 
     if name=="simclr":
@@ -43,39 +82,45 @@ def run(config,name,test_subjects):
     
         def ft_fun(self, test_subjects_train, test_subjects_test):
     
-            train_dl = DataLoader(
-                TuneDataset(test_subjects_train),
-                batch_size=self.config.batch_size,
-                shuffle=True,
-            )
-            test_dl = DataLoader(
-                TuneDataset(test_subjects_test),
-                batch_size=self.config.batch_size,
-                shuffle=False,
-            )
+            if self.config.cache_embeddings:
+                # sleep_ft builds its loaders from the cached features of the records
+                train_dl, test_dl = None, None
+            else:
+                train_dl = DataLoader(
+                    TuneDataset(test_subjects_train),
+                    batch_size=self.config.batch_size,
+                    shuffle=True,
+                )
+                test_dl = DataLoader(
+                    TuneDataset(test_subjects_test),
+                    batch_size=self.config.batch_size,
+                    shuffle=False,
+                )
     
             sleep_eval = sleep_ft(
                 self.config.exp_path + "/" + self.config.name + ".pt",
                 self.config,
                 train_dl,
                 test_dl,
+                train_records=test_subjects_train,
+                valid_records=test_subjects_test,
             )
             f1, kappa, bal_acc, acc = sleep_eval.fit()
     
             return f1, kappa, bal_acc, acc
     
         def do_kfold(self):
-    
+
             kfold = KFold(n_splits=self.config.splits,
                           shuffle=True,
                           random_state=1234)
-    
+
             k_acc, k_f1, k_kappa, k_bal_acc = 0, 0, 0, 0
             start = time.time()
-            
-            i = 0
+
+            folds = []
             for train_idx, test_idx in kfold.split(self.test_subjects):
-    
+
                 test_subjects_train = [self.test_subjects[i] for i in train_idx]
                 test_subjects_test = [self.test_subjects[i] for i in test_idx]
                 test_subjects_train = [
@@ -84,19 +129,41 @@ def run(config,name,test_subjects):
                 test_subjects_test = [
                     rec for sub in test_subjects_test for rec in sub
                 ]
-                
-                i+=1
-                print(f'Fold: {i}')
-                self.config.split = i
-                f1, kappa, bal_acc, acc = self.ft_fun(test_subjects_train, test_subjects_test)
+                folds.append((test_subjects_train, test_subjects_test))
+
+            # Parallel folds are CPU-only: forked workers cannot use the trainer's CUDA context
+            # and a spawn context would have to pickle the trainer with its data and logger
+            workers = min(self.config.kfold_workers, len(folds))
+            if workers > 1 and torch.cuda.is_available():
+                print('kfold_workers is CPU-only, folds run sequentially on the GPU')
+                workers = 1
+            if workers > 1:
+                global _kfold_state
+                print(f'Folds: {len(folds)} on {workers} workers')
+                _kfold_state = (self, folds)
+                try:
+                    with mp.get_context("fork").Pool(workers) as pool:
+                        results = pool.map(_kfold_worker, range(len(folds)))
+                finally:
+                    _kfold_state = None
+            else:
+                results = []
+                for i, fold in enumerate(folds):
+                    print(f'Fold: {i + 1}')
+                    self.config.split = i + 1
+                    with _fold_rng(self.config.kfold_seed + i):
+                        results.append(self.ft_fun(*fold))
+
+            # Merged in fold order, as in the sequential loop
+            for f1, kappa, bal_acc, acc in results:
                 k_f1 += f1
                 k_kappa += kappa
                 k_bal_acc += bal_acc
                 k_acc += acc
-          
+
             pit = time.time() - start
             print(f"Took {int(pit // 60)} min:{int(pit % 60)} secs")
-    
+
             return (
                 k_f1 / self.config.splits,
                 k_kappa / self.config.splits,
@@ -113,7 +180,8 @@ def run(config,name,test_subjects):
     
     class sleep_ft(nn.Module):
     
-        def __init__(self, chkpoint_pth, config, train_dl, valid_dl):
+        def __init__(self, chkpoint_pth, config, train_dl, valid_dl,
+                     train_records=None, valid_records=None):
             super(sleep_ft, self).__init__()
             self.device = torch.device(
                 "cuda" if torch.cuda.is_available() else "cpu")
@@ -128,6 +196,9 @@ def run(config,name,test_subjects):
             self.criterion = nn.CrossEntropyLoss()
             self.train_ft_dl = train_dl
             self.valid_ft_dl = valid_dl
+            self.head = self.model
+            if config.cache_embeddings:
+                self.cache_features(chkpoint_pth, train_records, valid_records)
     
             self.max_f1 = torch.tensor(0).to(self.device)
             self.max_acc = torch.tensor(0).to(self.device)
@@ -146,6 +217,31 @@ def run(config,name,test_subjects):
                                                patience=10,
                                                factor=0.2)
     
+        def cache_features(self, chkpoint_pth, train_records, valid_records):
+            """Trains the linear head on frozen encoder features computed once per record.
+
+            The loaders are built straight from the cached features, no raw window dataset
+            is built for the records.
+            """
+            cache = embedding_cache(
+                self.model.eeg_encoder,
+                chkpoint_pth,
+                self.device,
+                cache_dir=self.config.embedding_cache_path,
+                batch_size=self.batch_size,
+            )
+            self.head = self.model.lin
+            self.train_ft_dl = DataLoader(
+                TensorDataset(*cache.features(train_records)),
+                batch_size=self.config.batch_size,
+                shuffle=True,
+            )
+            self.valid_ft_dl = DataLoader(
+                TensorDataset(*cache.features(valid_records)),
+                batch_size=self.config.batch_size,
+                shuffle=False,
+            )
+
         def train_dataloader(self):
             return self.train_dl
     
@@ -155,14 +251,14 @@ def run(config,name,test_subjects):
         def training_step(self, batch, batch_idx):
             data, y = batch
             data, y = data.float().to(self.device), y.long().to(self.device)
-            outs = self.model(data)
+            outs = self.head(data)
             loss = self.criterion(outs, y)
             return loss
     
         def validation_step(self, batch, batch_idx):
             data, y = batch
             data, y = data.float().to(self.device), y.to(self.device)
-            outs = self.model(data)
+            outs = self.head(data)
             loss = self.criterion(outs, y)
             acc = accuracy(outs, y)
             return {
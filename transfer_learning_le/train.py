@@ -3,7 +3,7 @@ import numpy as np
 import torch
 import argparse
 import os
-from utils.dataloader import pretext_data
+from utils.dataloader import pretext_data, subject_store
 from helper_train import run
 from torch.utils.data import DataLoader
 from config import Config
@@ -52,15 +52,6 @@ TEST_FILE = [os.path.join(config.le_path, f) for f in TEST_FILE]
 
 print(f"Number of test records: {len(TEST_FILE)}")
 
-test_records = [np.load(f) for f in TEST_FILE]
-test_subjects = dict()
-
-for i, rec in enumerate(test_records):
-    if rec["_description"][0] not in test_subjects.keys():
-        test_subjects[rec["_description"][0]] = [rec]
-    else:
-        test_subjects[rec["_description"][0]].append(rec)
-
-test_subjects = list(test_subjects.values())
+test_subjects = subject_store(TEST_FILE, config.subject_cache_path)
 
 run(config, name, test_subjects)
@@ -9,11 +9,13 @@ This file can also be imported as a module and contains the following:
     * Load_Dataset - Loads the dataset and applies the augmentations.
     * data_generator - Generates a dataloader for the dataset.
     * cross_data_generator - Generates a k-fold dataloader for the given dataset. 
+    * subject_store - Loads the linear evaluation records once into shared arrays.
 """
 __author__ = "Likith Reddy, Vamsi Kumar"
 __version__ = "1.0.0"
 __email__ = "likith012@gmail.com, vamsi81523@gmail.com"
 
+import os
 import numpy as np
 import copy
 import torch
@@ -75,14 +77,29 @@ class TuneDataset(Dataset):
 
     def __getitem__(self, index):
 
-        X = self.X[index, :1, :]
+        if self.index is not None:
+            index = self.index[index]
+        X = np.array(self.X[index, :1, :])
         y = self.y[index]
         return X, y
 
     def __len__(self):
+        if self.index is not None:
+            return self.index.shape[0]
         return self.X.shape[0]
 
     def _add_subjects(self):
+        # Records of one subject_store: index its shared arrays instead of copying
+        stores = set(id(subject.store) if isinstance(subject, store_record) else None
+                     for subject in self.subjects)
+        if len(stores) == 1 and None not in stores:
+            self.X = self.subjects[0].store.X
+            self.y = self.subjects[0].store.y
+            self.index = np.concatenate(
+                [np.arange(subject.start, subject.stop) for subject in self.subjects])
+            return
+
+        self.index = None
         self.X = []
         self.y = []
         for subject in self.subjects:
@@ -90,3 +107,94 @@ class TuneDataset(Dataset):
             self.y.append(subject["y"])
         self.X = np.concatenate(self.X, axis=0)
         self.y = np.concatenate(self.y, axis=0)
+
+
+class store_record(object):
+    """View of a single record in a subject_store, indexed like the npz record"""
+
+    def __init__(self, store, key, start, stop):
+        self.store = store
+        self.key = key
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, name):
+        if name == "windows":
+            return self.store.X[self.start:self.stop]
+        if name == "y":
+            return self.store.y[self.start:self.stop]
+        raise KeyError(name)
+
+    def __len__(self):
+        return self.stop - self.start
+
+
+class subject_store(object):
+    """Linear evaluation records decompressed once into shared arrays.
+
+    Every record is read a single time into one (N, C, 3000) window array and one label
+    array and grouped into subjects by its description, in the order of files. Subjects
+    are lists of store_record views, so a TuneDataset over any fold indexes the shared
+    arrays instead of concatenating copies. With cache_path the arrays are written as
+    .npy once and memory mapped afterwards, so DataLoader workers and evaluation
+    processes share the same pages. The cache is rebuilt unless every record has the
+    same key, mtime and size as when it was written.
+    """
+
+    def __init__(self, files, cache_path=None):
+        keys = [os.path.splitext(os.path.basename(f))[0] for f in files]
+        stats = np.array([(os.stat(f).st_mtime, os.stat(f).st_size) for f in files],
+                         dtype=np.float64).reshape(-1, 2)
+        index_path = None if cache_path is None else os.path.join(cache_path, "index.npz")
+
+        if index_path is not None and os.path.exists(index_path):
+            index = np.load(index_path)
+            if (list(index["keys"]) != keys or "stats" not in index.files
+                    or not np.array_equal(index["stats"], stats)):
+                index = None
+        else:
+            index = None
+
+        if index is not None:
+            self.X = np.load(os.path.join(cache_path, "windows.npy"), mmap_mode="r")
+            self.y = np.load(os.path.join(cache_path, "y.npy"), mmap_mode="r")
+            descriptions, offsets = list(index["descriptions"]), index["offsets"]
+        else:
+            windows, ys, descriptions = [], [], []
+            for f in files:
+                with np.load(f) as rec:
+                    windows.append(rec["windows"])
+                    ys.append(rec["y"])
+                    descriptions.append(rec["_description"][0])
+            offsets = np.cumsum([0] + [len(y) for y in ys])
+            self.X = np.concatenate(windows, axis=0)
+            self.y = np.concatenate(ys, axis=0)
+            del windows, ys
+            if cache_path is not None:
+                self._save(cache_path, keys, stats, descriptions, offsets)
+
+        subjects = dict()
+        for i, (key, description) in enumerate(zip(keys, descriptions)):
+            rec = store_record(self, key, int(offsets[i]), int(offsets[i + 1]))
+            subjects.setdefault(description, []).append(rec)
+        self.subjects = list(subjects.values())
+
+    def _save(self, cache_path, keys, stats, descriptions, offsets):
+        os.makedirs(cache_path, exist_ok=True)
+        for name, arr in (("windows", self.X), ("y", self.y)):
+            np.save(os.path.join(cache_path, name + ".tmp.npy"), arr)
+            os.replace(os.path.join(cache_path, name + ".tmp.npy"),
+                       os.path.join(cache_path, name + ".npy"))
+        np.savez(os.path.join(cache_path, "index.tmp.npz"),
+                 keys=np.array(keys),
+                 stats=stats,
+                 descriptions=np.array(descriptions),
+                 offsets=offsets)
+        os.replace(os.path.join(cache_path, "index.tmp.npz"),
+                   os.path.join(cache_path, "index.npz"))
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __getitem__(self, index):
+        return self.subjects[index]